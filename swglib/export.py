@@ -9,21 +9,77 @@
 ###########################################################
 
 import os
+import asyncio
+import csv
+import fcntl
+import heapq
+import gzip
+import hashlib
+import lzma
+import zlib
+import http.client
+import sqlite3
 import subprocess
+import threading
 import xmlrpc.client as xc
-from datetime import datetime, timedelta
-from itertools import takewhile
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
+from itertools import chain, groupby
+from contextlib import contextmanager
+from array import array
+from xml.parsers import expat
 import numpy as np
-from time import gmtime
-from collections import namedtuple
+from time import gmtime, monotonic, time, sleep
+from collections import namedtuple, OrderedDict
 import tempfile
 import json
+from urllib.parse import urlsplit
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 json.encoder.FLOAT_REPR = lambda o: format(o, '.9f')
 
 ARCHIVE_MAX_XMLRPC_SAMPLES = 10000
+# When fetching several channels at once, those whose next page starts within
+# this distance of each other are requested together
+ARCHIVE_BATCH_TOLERANCE = np.timedelta64(1, 's')
+ARCHIVE_MAX_IDLE_CONNECTIONS = 8
+# Where the catalogs of archives and channels for each site are kept, and
+# for how long (in seconds) they're trusted before asking the server again
+ARCHIVE_CATALOG_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'swglib')
+ARCHIVE_CATALOG_TTL = 86400
+# Seconds before asking again for an archive or channel unknown to the catalog
+ARCHIVE_CATALOG_RETRY = 60
+# Failed page requests are retried this many times, waiting (in seconds)
+# twice as long each time, starting with ARCHIVE_RETRY_BACKOFF
+ARCHIVE_RETRIES = 5
+ARCHIVE_RETRY_BACKOFF = 1.0
+ARCHIVE_RETRY_MAX_BACKOFF = 30.0
+# Requests in flight to each site, shared by all the processes in the host.
+# Bulk transfers can only use some of them, leaving room for interactive use
+ARCHIVE_MAX_INFLIGHT = 8
+ARCHIVE_BULK_INFLIGHT = 6
+ARCHIVE_SCHEDULER_DIR = os.path.join(tempfile.gettempdir(), 'swglib-scheduler')
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 1
+# Samples stamped up to this long before archiver.names was called may still
+# be on their way to the archive
+ARCHIVE_RANGE_MARGIN = np.timedelta64(5, 'm')
+# Values for the `how` argument of archiver.values, for each decimation mode
+ARCHIVE_HOW_RAW = 0
+ARCHIVE_HOW = {
+        'average': 2,
+        'plotbin': 3,
+        }
+# Samples per bin returned, at most, by each decimation mode
+ARCHIVE_SAMPLES_PER_BIN = {
+        'average': 1,
+        'plotbin': 4,
+        }
 ARCHIVE_EXPORTER = '/gemsoft/opt/epics/extensions/bin/linux-x86_64/ArchiveExport'
 ARCHIVE_EXPORT_DATA_PATH = '/gemsoft/var/data/gea/data/data/{source}/master_index'
+# Bytes read from the ArchiveExport pipe at a time
+ARCHIVE_EXPORT_CHUNK_SIZE = 262144
 ARCHIVE_SITE_URL = {
         'MK': 'http://geanorth.hi.gemini.edu/run/ArchiveDataServer.cgi',
         'CP': 'http://geasouth.cl.gemini.edu/run/ArchiveDataServer.cgi',
@@ -76,72 +132,1571 @@ def _format_value(value):
         return datetime.strftime(value, '%m/%d/%Y %H:%M:%S.%f')
     return str(value)
 
+class Decimation(namedtuple('Decimation', 'mode width')):
+    """
+    Asks the archiver to decimate the data before sending it. `mode` is one
+    of `'average'` (the average of each bin) or `'plotbin'` (the first, last,
+    minimum and maximum samples of each bin), and `width` the size of the
+    bins, in seconds.
+
+    Bins are aligned to multiples of `width` since the epoch, so that the
+    same bins are produced for overlapping queries.
+    """
+    __slots__ = ()
+
+    def __new__(cls, mode, width):
+        if mode not in ARCHIVE_HOW:
+            raise ValueError("Unknown decimation mode: {0}".format(mode))
+        if width <= 0:
+            raise ValueError("The bin width must be positive")
+        return super(Decimation, cls).__new__(cls, mode, width)
+
+    @property
+    def how(self):
+        return ARCHIVE_HOW[self.mode]
+
+    @property
+    def period(self):
+        return np.timedelta64(int(round(self.width * 1000000000)), 'ns')
+
+    @property
+    def cache_name(self):
+        "Name used to keep the decimated data apart from the raw one in the cache"
+        return '{0}_{1:g}s'.format(self.mode, self.width)
+
+    def bins(self, start, end):
+        "Returns the first bin edge at, or before, `start`, and the number of bins up to `end`"
+        period = self.period.astype(np.int64)
+        first = todatetime64(start).astype('datetime64[ns]').astype(np.int64) // period * period
+        last = todatetime64(end).astype('datetime64[ns]').astype(np.int64)
+        return np.datetime64(int(first), 'ns'), max(int(-(-(last - first) // period)), 1)
+
 class ArchiveFileExporter(object):
-    def __init__(self, source, bin_exec=ARCHIVE_EXPORTER):
+    """
+    Retrieves data from the archives stored in this host, running the
+    ArchiveExport tool. `bin_exec` is the path to the tool, or a list with
+    the command line to run in its place (eg. `[sys.executable, 'script.py']`).
+    """
+    def __init__(self, source, bin_exec=ARCHIVE_EXPORTER, chunk_size=ARCHIVE_EXPORT_CHUNK_SIZE):
         self.site = 'local'
         self.source = ARCHIVE_EXPORT_DATA_PATH.format(source=source)
         self.bin_exec = bin_exec
+        self.chunk_size = chunk_size
 
-    def cmd_line_builder(self, channel, start, end, output=None):
+    def cmd_line_builder(self, channel, start, end, output=None, source=None, decimation=None):
+        # The arguments are not passed through a shell: no quoting needed
         args = [channel, '-format', 'decimal',
-                         '-start', "'{0}'".format(_format_value(start)),
-                         '-end', "'{0}'".format(_format_value(end))]
+                         '-start', _format_value(todatetime(start)),
+                         '-end', _format_value(todatetime(end))]
 
+        if decimation is not None:
+            args.extend(['-' + decimation.mode, '{0:g}'.format(decimation.width)])
         if output is not None:
             args.extend(['-output', output])
 
-        return [self.bin_exec, self.source] + args
+        index = self.source if source is None else ARCHIVE_EXPORT_DATA_PATH.format(source=source)
+        cmd = list(self.bin_exec) if isinstance(self.bin_exec, (list, tuple)) else [self.bin_exec]
+        return cmd + [index] + args
+
+    def retrieve_blocks(self, source, channel, start, end, decimation=None):
+        """
+        Runs ArchiveExport with its output piped to us, and yields the samples
+        as `SampleBlock`s, parsing the output in chunks as it arrives.
+
+        `decimation` (a `Decimation`) is passed on to ArchiveExport.
+        """
+        if decimation is not None:
+            start = decimation.bins(start, end)[0]
+        cmd = self.cmd_line_builder(channel, start, end, source=source, decimation=decimation)
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+        try:
+            pending = b''
+            while True:
+                data = proc.stdout.read1(self.chunk_size)
+                if not data:
+                    break
+                lines = (pending + data).split(b'\n')
+                pending = lines.pop()
+                block = decode_export_lines(lines)
+                if len(block) > 0:
+                    yield block
+            block = decode_export_lines([pending])
+            if len(block) > 0:
+                yield block
+        finally:
+            # Don't leave the tool around if the consumer gives up early
+            if proc.poll() is None:
+                proc.kill()
+            proc.stdout.close()
+            proc.wait()
+        if proc.returncode != 0:
+            raise subprocess.CalledProcessError(proc.returncode, cmd)
+
+    def retrieve(self, source, channel, start, end, decimation=None):
+        yield from iter_samples(self.retrieve_blocks(source, channel, start, end, decimation))
 
-    def retrieve(self, source, channel, start, end):
-        raise NotImplementedError("This functionality hasn't been implemented")
+    def find_archive(self, channel):
+        return map_pv_to_db(channel)
 
 def split_timestamp_to_dt(sample):
     return np.datetime64(datetime.utcfromtimestamp(sample['secs'])) + np.timedelta64(sample['nano'], 'ns')
 
+class SampleBlock(object):
+    """
+    A sequence of samples stored as contiguous arrays: `stamps` holds one
+    `datetime64[ns]` timestamp per sample, and `values` is a 2-D array with
+    one row per sample (`float64` for the usual double channels).
+
+    Iterating over a block (or indexing it with an integer) produces the same
+    `(stamp, value, ...)` tuples as `retrieve`. Slicing it, or indexing it with
+    a boolean mask, returns a new `SampleBlock`.
+    """
+    __slots__ = ('stamps', 'values')
+
+    def __init__(self, stamps, values):
+        self.stamps = stamps
+        self.values = values
+
+    @classmethod
+    def empty(cls, width=1, dtype=np.float64):
+        return cls(np.empty(0, dtype='datetime64[ns]'), np.empty((0, width), dtype=dtype))
+
+    @classmethod
+    def concatenate(cls, blocks):
+        blocks = [b for b in blocks if len(b) > 0]
+        if not blocks:
+            return cls.empty()
+        elif len(blocks) == 1:
+            return blocks[0]
+        return cls(np.concatenate([b.stamps for b in blocks]),
+                   np.concatenate([b.values for b in blocks]))
+
+    @property
+    def width(self):
+        return self.values.shape[1]
+
+    def __len__(self):
+        return len(self.stamps)
+
+    def __iter__(self):
+        for stamp, row in zip(self.stamps, self.values.tolist()):
+            yield (stamp,) + tuple(row)
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            return (self.stamps[key],) + tuple(self.values[key].tolist())
+        return SampleBlock(self.stamps[key], self.values[key])
+
+    def after(self, stamp):
+        "Returns the samples stamped strictly after `stamp` (all of them if it's `None`)"
+        if stamp is None or len(self) == 0 or self.stamps[0] > stamp:
+            return self
+        return self[self.stamps > stamp]
+
+    def between(self, first, last):
+        "Returns the samples stamped within `[first, last]`. The stamps must be sorted"
+        lo = np.searchsorted(self.stamps, first, side='left')
+        hi = np.searchsorted(self.stamps, last, side='right')
+        if lo == 0 and hi == len(self):
+            return self
+        return SampleBlock(self.stamps[lo:hi], self.values[lo:hi])
+
+    def since(self, stamp):
+        "Returns the samples stamped at, or after, `stamp`"
+        if len(self) == 0 or self.stamps[0] >= stamp:
+            return self
+        return self[self.stamps >= stamp]
+
+def iter_samples(blocks):
+    """
+    Yields the samples in `blocks` (an iterable of `SampleBlock`s) one by one.
+    Closing this generator closes `blocks` too, eg. to stop a download.
+    """
+    try:
+        for block in blocks:
+            yield from block
+    finally:
+        close = getattr(blocks, 'close', None)
+        if close is not None:
+            close()
+
+# Numpy types for the values of each of the archiver's data types:
+# 0 - string, 1 - enum, 2 - int, 3 - double
+ARCHIVE_TYPE_DTYPE = {0: object, 1: np.int64, 2: np.int64, 3: np.float64}
+
+def decode_block(result):
+    """
+    Turns the result of `archiver.values` for one channel into a `SampleBlock`,
+    using a few bulk NumPy operations instead of converting sample by sample.
+    """
+    samples = result['values']
+    if isinstance(samples, SampleBlock):
+        # Already decoded by ValuesParser
+        return samples
+    n = len(samples)
+    dtype = ARCHIVE_TYPE_DTYPE.get(result.get('type'), np.float64)
+    if n == 0:
+        return SampleBlock.empty(result.get('count', 1), dtype)
+    secs = np.fromiter((s['secs'] for s in samples), dtype=np.int64, count=n)
+    nano = np.fromiter((s['nano'] for s in samples), dtype=np.int64, count=n)
+    values = values_array([s['value'] for s in samples], dtype)
+    return SampleBlock((secs * 1000000000 + nano).view('datetime64[ns]'), values)
+
+def values_array(rows, dtype):
+    "Builds the 2-D array of values for a (non-empty) list of sample values"
+    try:
+        values = np.array(rows, dtype=dtype)
+    except ValueError:
+        # Not all the samples have the same number of elements (it happens
+        # with disconnected array channels). Pad the short ones.
+        width = max(len(v) for v in rows)
+        values = np.full((len(rows), width), np.nan if dtype is np.float64 else 0, dtype=dtype)
+        for row, v in zip(values, rows):
+            row[:len(v)] = v
+    if values.ndim == 1:
+        values = values.reshape(len(rows), -1)
+    return values
+
+def _export_float(text):
+    try:
+        return float(text)
+    except ValueError:
+        # Values like #N/A, for disconnected channels, etc.
+        return np.nan
+
+def decode_export_lines(lines):
+    """
+    Turns lines of ArchiveExport's output (`bytes`, in decimal format) into a
+    `SampleBlock`. Comments and blank lines are skipped.
+    """
+    stamps = []
+    rows = []
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith(b'#'):
+            continue
+        fields = line.decode('utf-8', 'replace').split('\t')
+        # MM/DD/YYYY HH:MM:SS.fffffffff to ISO 8601, that NumPy can parse
+        stamp = fields[0]
+        stamps.append('{0}-{1}-{2}T{3}'.format(stamp[6:10], stamp[0:2], stamp[3:5], stamp[11:]))
+        rows.append(fields[1:])
+    if not stamps:
+        return SampleBlock.empty()
+    try:
+        values = np.array(rows, dtype=np.float64)
+        if values.ndim == 1:
+            values = values.reshape(len(rows), -1)
+    except ValueError:
+        values = values_array([[_export_float(x) for x in row] for row in rows], np.float64)
+    return SampleBlock(np.array(stamps, dtype='datetime64[ns]'), values)
+
+class ValuesParser(object):
+    """
+    Streaming parser for `archiver.values` responses, built on expat.
+
+    The bulk of the response (the samples for each channel) is decoded as it
+    goes through the parser, straight into preallocated typed buffers that
+    are then exposed to NumPy without copying, instead of building a
+    dictionary per sample. Everything else (channel names, metadata, faults)
+    is handed to the standard `xmlrpc.client.Unmarshaller`. The result is the
+    same as for a stock call, except that each channel's `values` is a
+    `SampleBlock`.
+
+    Buffers are sized for `count` samples per channel, and grow if needed.
+    It follows the interface used by `xmlrpc.client` for its parser and
+    unmarshaller: data is passed to `feed`, and `close` returns the result.
+    """
+    # Depth (counting from <methodResponse> as 1) of the <value> holding the
+    # list of samples for a channel:
+    #   methodResponse/params/param/value/array/data/value/struct/member/value
+    VALUES_DEPTH = 10
+    INT_TAGS = frozenset(('int', 'i4', 'i8', 'boolean'))
+
+    def __init__(self, count=ARCHIVE_MAX_XMLRPC_SAMPLES):
+        self._stock = xc.Unmarshaller()
+        self._stock.xml(None, None)
+        self._count = max(count, 1)
+        self._depth = 0
+        self._text = ''
+        self._member = None
+        self._meta = {}
+        self._channels = []
+        self._capture = None
+        self._result = None
+        self._parser = expat.ParserCreate(None, None)
+        self._parser.buffer_text = True
+        self._parser.buffer_size = 65536
+        self._set_handlers(self._start, self._data, self._end)
+
+    def _set_handlers(self, start, data, end):
+        self._parser.StartElementHandler = start
+        self._parser.CharacterDataHandler = data
+        self._parser.EndElementHandler = end
+
+    def feed(self, data):
+        self._parser.Parse(data, False)
+
+    def close(self):
+        if self._result is None:
+            self._parser.Parse(b'', True)
+            result = self._stock.close()
+            channels = iter(self._channels)
+            for entry in result[0] if result and isinstance(result[0], list) else ():
+                meta = next(channels, {})
+                if isinstance(entry, dict) and isinstance(meta.get('values'), _SampleCapture):
+                    entry['values'] = meta['values'].block(entry.get('type'))
+            self._result = result
+        return self._result
+
+    # Handlers for everything but the samples
+
+    def _start(self, tag, attrs):
+        self._depth += 1
+        self._text = ''
+        if tag == 'value' and self._depth == self.VALUES_DEPTH and self._member == 'values':
+            self._capture = self._meta['values'] = \
+                    _SampleCapture(self._count, self._meta.get('count'), self._meta.get('type'))
+            # For numeric channels the layout of the samples is known, and
+            # everything can be worked out from the closing tags. This saves
+            # half of the callbacks
+            start = self._sample_start if self._capture.tracks_leaves else None
+            self._set_handlers(start, self._data, self._sample_end)
+            return
+        elif tag == 'struct' and self._depth == self.VALUES_DEPTH - 2:
+            # A new channel
+            self._meta = {}
+            self._channels.append(self._meta)
+        self._stock.start(tag, attrs)
+
+    def _data(self, text):
+        self._text += text
+        if self._capture is None:
+            self._stock.data(text)
+
+    def _end(self, tag):
+        depth = self._depth
+        self._depth -= 1
+        self._stock.end(tag)
+        if depth == self.VALUES_DEPTH and tag == 'name':
+            self._member = self._text
+        elif depth == self.VALUES_DEPTH + 1 and tag in self.INT_TAGS and self._member in ('type', 'count'):
+            self._meta[self._member] = int(self._text)
+
+    # Handlers for the list of samples. The layout is:
+    #
+    #   <value><array><data>
+    #     <value><struct>
+    #       <member><name>secs</name><value><int>...</int></value></member>
+    #       ...
+    #       <member><name>value</name><value><array><data>
+    #          <value><double>...</double></value> ...
+    #       </data></array></value></member>
+    #     </struct></value>
+    #     ...
+    #   </data></array></value>
+    #
+    # When the start handler is disabled, self._text accumulates the
+    # whitespace between tags, which is fine for numbers and names.
+
+    def _sample_start(self, tag, attrs):
+        self._text = ''
+        if tag != 'value' and tag != 'array' and tag != 'data' and tag != 'member' and tag != 'name':
+            self._capture.leaf = tag
+
+    def _sample_end(self, tag):
+        cap = self._capture
+        if tag == 'double':
+            cap.add(float(self._text))
+        elif tag in self.INT_TAGS:
+            member = cap.member
+            if member == 'secs':
+                cap.secs = int(self._text)
+            elif member == 'nano':
+                cap.nano = int(self._text)
+            elif member == 'value':
+                cap.add(int(self._text))
+        elif tag == 'name':
+            cap.member = self._text.strip()
+        elif tag == 'struct':
+            cap.commit()
+            cap.member = None
+        elif tag == 'string':
+            cap.add(self._text)
+        elif tag == 'array':
+            # Outside of a sample, this closes the list of samples. Inside,
+            # the list of elements of the value
+            if cap.member is None:
+                cap.closing = True
+            else:
+                cap.member = ''
+        elif tag == 'value':
+            if cap.closing:
+                # Done with this channel. Let the stock unmarshaller see an
+                # empty list of samples, and go back to the regular handlers
+                self._capture = None
+                self._depth = self.VALUES_DEPTH - 1
+                self._set_handlers(self._start, self._data, self._end)
+                for t in ('value', 'array', 'data'):
+                    self._stock.start(t, {})
+                for t in ('data', 'array', 'value'):
+                    self._stock.end(t)
+            elif cap.leaf is None and cap.member == 'value' and cap.tracks_leaves:
+                # An untyped <value> is a string
+                cap.add(self._text)
+            cap.leaf = None
+        self._text = ''
+
+class _SampleCapture(object):
+    """
+    Accumulates the samples of one channel for `ValuesParser`. Timestamps and
+    numeric values are stored in preallocated `array.array` buffers; NumPy
+    arrays are built on top of them once the channel is complete.
+    """
+    def __init__(self, capacity, width, type_):
+        self.n = 0
+        self.width = width
+        self.member = None
+        self.leaf = None
+        self.closing = False
+        self.secs = self.nano = 0
+        self.stamps = array('q', bytes(8 * capacity))
+        # Non-numeric values (or mixed ones) are kept as Python objects
+        self.numeric = type_ in (1, 2, 3)
+        # Whether the parser reports the element types (see `ValuesParser`)
+        self.tracks_leaves = not self.numeric
+        self.flat = array('d' if type_ == 3 else 'q', bytes(8 * capacity * (width or 1)))
+        self.k = 0
+        self.row_start = 0
+        self.rows = []
+        self.row = []
+
+    def add(self, value):
+        if self.numeric:
+            if self.k == len(self.flat):
+                self.flat.extend(self.flat)
+            try:
+                self.flat[self.k] = value
+            except TypeError:
+                # Not what the channel type said. Go the slow way
+                self._demote()
+                self.row.append(value)
+                return
+            self.k += 1
+        else:
+            self.row.append(value)
+
+    def _demote(self):
+        step = self.width or 1
+        flat = self.flat[:self.k].tolist()
+        self.rows = [flat[i:i + step] for i in range(0, self.row_start, step)]
+        self.row = flat[self.row_start:]
+        self.numeric = False
+
+    def commit(self):
+        if self.n == len(self.stamps):
+            self.stamps.extend(self.stamps)
+        self.stamps[self.n] = self.secs * 1000000000 + self.nano
+        if self.numeric:
+            length = self.k - self.row_start
+            if self.width is None:
+                self.width = length
+            elif length != self.width:
+                # Keep the rows apart, to pad them later
+                self._demote()
+        if not self.numeric:
+            self.rows.append(self.row)
+            self.row = []
+        self.n += 1
+        self.secs = self.nano = 0
+        self.row_start = self.k
+
+    def block(self, type_):
+        dtype = ARCHIVE_TYPE_DTYPE.get(type_, np.float64)
+        if self.n == 0:
+            return SampleBlock.empty(self.width or 1, dtype)
+        stamps = np.frombuffer(self.stamps, dtype=np.int64, count=self.n).view('datetime64[ns]')
+        if self.numeric:
+            values = np.frombuffer(self.flat, dtype=np.dtype(self.flat.typecode), count=self.k)
+            return SampleBlock(stamps, values.reshape(self.n, self.width).astype(dtype, copy=False))
+        return SampleBlock(stamps, values_array(self.rows, dtype))
+
+def loads_values(data, count=ARCHIVE_MAX_XMLRPC_SAMPLES):
+    "Decodes a complete `archiver.values` response using `ValuesParser`"
+    parser = ValuesParser(count)
+    parser.feed(data)
+    return parser.close()
+
+def next_page_start(page, end, count=ARCHIVE_MAX_XMLRPC_SAMPLES, window_end=None):
+    """
+    Given a `page` of samples (a `SampleBlock`) obtained for a query ending at
+    `end`, returns the starting point for the next page, or `None` if the query
+    is complete.
+
+    `count` is the number of samples that was requested for the page, and
+    `window_end` the end of the time window requested, if it was narrower
+    than the whole query.
+    """
+    if len(page) > 0 and page.stamps[-1] >= end:
+        return None
+    elif len(page) >= count:
+        return addtotimestamp(page.stamps[-1], timedelta(microseconds=10))
+    elif window_end is not None and window_end < end:
+        return window_end
+    return None
+
+def page_stats(key, start, end, count, pages, latency):
+    """
+    Builds the `PageStats` for a request, out of the `SampleBlock`s received
+    for each channel
+    """
+    samples = values = 0
+    span = 0.
+    for page in pages:
+        values += page.values.size
+        if len(page) > samples:
+            samples = len(page)
+            inside = page.since(start).stamps
+            if len(inside) > 1:
+                span = (inside[-1] - inside[0]).astype('timedelta64[ns]').astype(np.int64) / 1e9
+    return PageStats(key, start, end, count, samples, values, span, latency)
+
+def split_window(start, end, slices):
+    """
+    Splits the `[start, end]` interval (`numpy.datetime64` objects) in `slices`
+    consecutive windows of (roughly) the same length. Returns a list of
+    `(start, end)` pairs. Consecutive windows share their boundary.
+    """
+    slices = max(1, int(slices))
+    if end <= start:
+        return [(start, end)]
+    s, e = start.astype('datetime64[ns]').astype(np.int64), end.astype('datetime64[ns]').astype(np.int64)
+    bounds = [np.datetime64(int(s + ((e - s) * n) // slices), 'ns') for n in range(slices + 1)]
+    return list(zip(bounds[:-1], bounds[1:]))
+
 def addtotimestamp(dt, delta):
     if isinstance(dt, datetime):
         return dt + delta
     else:
         return np.datetime64(int(dt.astype(int) + int(delta.total_seconds() * 1000000)), 'ns')
 
+class PooledTransport(xc.Transport):
+    """
+    XML-RPC transport keeping a pool of keep-alive HTTP connections. Unlike the
+    default transport, a single instance can be shared by any number of
+    `xmlrpc.client.Server` objects, even from different threads: each request
+    takes an idle connection from the pool (or opens a new one) and gives it
+    back once the response has been read.
+
+    `gzip` controls whether the server is allowed to compress the responses.
+    At most `maxsize` idle connections are kept open.
+    """
+    def __init__(self, gzip=True, maxsize=ARCHIVE_MAX_IDLE_CONNECTIONS):
+        super().__init__()
+        self.accept_gzip_encoding = gzip
+        self.maxsize = maxsize
+        self._forget_connections()
+
+    def _forget_connections(self):
+        self._pid = os.getpid()
+        self._idle = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def make_connection(self, host):
+        if self._pid != os.getpid():
+            # Inherited through a fork (eg. by an exporter created before
+            # starting a process pool). The parent keeps using those sockets
+            self._forget_connections()
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            return conn[1]
+        chost, self._extra_headers, x509 = self.get_host_info(host)
+        with self._lock:
+            for n, (h, c) in enumerate(self._idle):
+                if h == chost:
+                    conn = self._idle.pop(n)
+                    break
+        if conn is None:
+            conn = (chost, http.client.HTTPConnection(chost))
+        self._local.conn = conn
+        return conn[1]
+
+    def single_request(self, host, handler, request_body, verbose=False):
+        try:
+            return super().single_request(host, handler, request_body, verbose)
+        finally:
+            # If the request failed, close() has already discarded the connection
+            conn = getattr(self._local, 'conn', None)
+            self._local.conn = None
+            if conn is not None:
+                with self._lock:
+                    if len(self._idle) < self.maxsize:
+                        self._idle.append(conn)
+                        conn = None
+                if conn is not None:
+                    conn[1].close()
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        self._local.conn = None
+        if conn is not None:
+            conn[1].close()
+
+    @contextmanager
+    def unmarshaller(self, factory):
+        """
+        Within this context, responses to calls made from the current thread
+        are decoded by the unmarshaller returned by `factory()` (eg.
+        `ValuesParser`), instead of the standard parser and unmarshaller.
+        """
+        self._local.unmarshaller = factory
+        try:
+            yield
+        finally:
+            self._local.unmarshaller = None
+
+    def getparser(self):
+        factory = getattr(self._local, 'unmarshaller', None)
+        if factory is None:
+            return super().getparser()
+        parser = factory()
+        return parser, parser
+
+    def parse_response(self, response):
+        # Same as the standard one, but reading larger chunks at a time
+        if response.getheader('Content-Encoding', '') == 'gzip':
+            stream = xc.GzipDecodedResponse(response)
+        else:
+            stream = response
+        p, u = self.getparser()
+        while True:
+            data = stream.read(65536)
+            if not data:
+                break
+            p.feed(data)
+        if stream is not response:
+            stream.close()
+        p.close()
+        return u.close()
+
+    def close_idle(self):
+        "Closes all the idle connections in the pool"
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for _, conn in idle:
+            conn.close()
+
+_site_transports = {}
+_site_transports_lock = threading.Lock()
+
+def get_transport(url, gzip=True):
+    """
+    Returns the `PooledTransport` shared by all the exporters talking to `url`
+    in this process. The transport (and its connections) live for the rest of
+    the process.
+    """
+    with _site_transports_lock:
+        # Children of a fork must not write to the parent's connections
+        key = (url, gzip, os.getpid())
+        if key not in _site_transports:
+            _site_transports[key] = PooledTransport(gzip=gzip)
+        return _site_transports[key]
+
+def is_transient(error):
+    "Tells if a failed request is worth retrying"
+    if isinstance(error, xc.ProtocolError):
+        # Server side trouble (eg. 502 from a proxy, 503), not a bad request
+        return error.errcode >= 500
+    return isinstance(error, (OSError, http.client.HTTPException, asyncio.IncompleteReadError))
+
+def retry_delay(attempt, backoff=ARCHIVE_RETRY_BACKOFF):
+    return min(backoff * 2 ** attempt, ARCHIVE_RETRY_MAX_BACKOFF)
+
+PageStats = namedtuple('PageStats', 'key start end count samples values span latency')
+ChannelRange = namedtuple('ChannelRange', 'first last')
+
+class ArchiveCatalog(object):
+    """
+    On-disk catalog of the archives at `site`: the key for each archive and,
+    for each of them, the channels they hold and the span of their data.
+    `url` tells which server the catalog describes, if it's not the usual
+    one for `site` (see `catalog_path`).
+
+    The catalog is loaded from `path` at creation and answers lookups without
+    contacting the server. The lookups that take a `server` refresh the
+    entries older than `ttl` seconds (or unknown entries, no more than once
+    every `ARCHIVE_CATALOG_RETRY` seconds), saving the result back.
+    """
+    def __init__(self, site, path=None, ttl=ARCHIVE_CATALOG_TTL, url=None):
+        self.site = site
+        self.url = url if url is not None else ARCHIVE_SITE_URL.get(site)
+        self.path = path if path is not None else catalog_path(site, self.url)
+        self.ttl = ttl
+        self._lock = threading.RLock()
+        self._updated = 0
+        self._scanned = 0
+        self._keys = {}
+        self._archives = {}
+        self._channels = {}
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as source:
+                content = json.load(source)
+        except (IOError, OSError, ValueError):
+            # Missing or corrupt: it will be filled from the server
+            return
+        with self._lock:
+            self._updated = content['updated']
+            self._scanned = content.get('scanned', 0)
+            self._keys = dict((name, entry['key']) for (name, entry) in content['archives'].items())
+            self._archives = {}
+            for name, entry in content['archives'].items():
+                if 'channels' in entry:
+                    ranges = dict((channel, ChannelRange(np.datetime64(first, 'ns'), np.datetime64(last, 'ns')))
+                                  for (channel, (first, last)) in entry['channels'].items())
+                    self._set_channels(name, entry['channels_updated'], ranges)
+
+    def save(self):
+        with self._lock:
+            archives = {}
+            for name, key in self._keys.items():
+                archives[name] = {'key': key}
+                if name in self._archives:
+                    updated, ranges = self._archives[name]
+                    archives[name]['channels_updated'] = updated
+                    archives[name]['channels'] = dict((channel, [int(r.first.astype(np.int64)),
+                                                                 int(r.last.astype(np.int64))])
+                                                      for (channel, r) in ranges.items())
+            content = {'site': self.site, 'updated': self._updated, 'scanned': self._scanned,
+                       'archives': archives}
+        directory = os.path.dirname(self.path) or '.'
+        if not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        # Write and rename, so that other processes never see a partial catalog
+        with tempfile.NamedTemporaryFile('w', dir=directory, delete=False) as dest:
+            json.dump(content, dest)
+        os.replace(dest.name, self.path)
+
+    def _outdated(self, updated, missing):
+        age = time() - updated
+        return age > self.ttl or (missing and age > ARCHIVE_CATALOG_RETRY)
+
+    def _set_channels(self, archive, updated, ranges):
+        self._archives[archive] = (updated, ranges)
+        for channel, span in ranges.items():
+            # Channels kept in more than one archive are looked for where
+            # their latest data is
+            other = self._channels.get(channel)
+            current = self._archives[other][1].get(channel) if other not in (None, archive) else None
+            if current is None or current.last < span.last:
+                self._channels[channel] = archive
+
+    def update_archives(self, server):
+        self.set_archives(server.archiver.archives())
+
+    def set_archives(self, archives):
+        "Replaces the list of archives with the result of `archiver.archives`"
+        keys = dict((x['name'], x['key']) for x in archives)
+        with self._lock:
+            self._keys = keys
+            self._updated = time()
+        self.save()
+
+    def update_channels(self, server, archive):
+        updated = time()
+        ranges = {}
+        for entry in server.archiver.names(self.key(archive, server), ''):
+            ranges[entry['name']] = ChannelRange(
+                    first=np.datetime64(entry['start_sec'] * 1000000000 + entry['start_nano'], 'ns'),
+                    last=np.datetime64(entry['end_sec'] * 1000000000 + entry['end_nano'], 'ns'))
+        with self._lock:
+            self._set_channels(archive, updated, ranges)
+        self.save()
+
+    def key(self, archive, server=None):
+        "Returns the key for `archive`. Raises `KeyError` if it's not known"
+        with self._lock:
+            if server is not None and self._outdated(self._updated, archive not in self._keys):
+                self.update_archives(server)
+            return self._keys[archive]
+
+    def ranges(self, archive, server=None, channel=None):
+        """
+        Returns a dictionary mapping the channels in `archive` to their
+        `ChannelRange`, and the time (in seconds since the epoch) at which
+        the server reported them. If `channel` is not in the dictionary the
+        server is asked again (subject to `ARCHIVE_CATALOG_RETRY`).
+        """
+        with self._lock:
+            updated, ranges = self._archives.get(archive, (0, {}))
+            if server is not None and self._outdated(updated, channel is not None and channel not in ranges):
+                self.update_channels(server, archive)
+                updated, ranges = self._archives[archive]
+            return ranges, updated
+
+    def archive_for(self, channel, server=None):
+        """
+        Returns the name of the archive holding `channel`, or `None` if it's
+        not known. With a `server`, an unknown channel is looked for in all
+        the archives.
+        """
+        with self._lock:
+            archive = self._channels.get(channel)
+            if archive is None and server is not None and self._outdated(self._scanned, True):
+                if self._outdated(self._updated, False):
+                    self.update_archives(server)
+                for name in sorted(self._keys):
+                    if self._outdated(self._archives.get(name, (0, None))[0], True):
+                        self.update_channels(server, name)
+                self._scanned = time()
+                self.save()
+                archive = self._channels.get(channel)
+            return archive
+
+def catalog_path(site, url=None):
+    """
+    Returns the file for the catalog of the server at `url`. The usual
+    server for `site` gets `catalog-<site>.json`. Others (eg. a local
+    stand-in) get a name of their own, so that their archives are never
+    mixed up with the site's.
+    """
+    if url is None or url == ARCHIVE_SITE_URL.get(site):
+        name = 'catalog-{0}.json'.format(site)
+    else:
+        name = 'catalog-{0}-{1}.json'.format(site, hashlib.sha1(url.encode('utf-8')).hexdigest()[:12])
+    return os.path.join(ARCHIVE_CATALOG_DIR, name)
+
+_site_catalogs = {}
+_site_catalogs_lock = threading.Lock()
+
+def get_catalog(site, url=None):
+    "Returns the `ArchiveCatalog` shared by all the exporters talking to `url` (by default, the one for `site`)"
+    url = url if url is not None else ARCHIVE_SITE_URL.get(site)
+    with _site_catalogs_lock:
+        if (site, url) not in _site_catalogs:
+            _site_catalogs[(site, url)] = ArchiveCatalog(site, url=url)
+        return _site_catalogs[(site, url)]
+
+class FetchScheduler(object):
+    """
+    Limits the number of requests in flight to `site`. The limit holds for
+    all the processes in the host: each request needs one of `max_inflight`
+    slots, which are lock files under `lock_dir`, held with `flock`.
+
+    Requests with `PRIORITY_BULK` are restricted to the first `bulk_inflight`
+    slots, so that interactive queries can still get through while a harvest
+    is running. Within a process, waiting requests get the free slots in
+    order of priority, and then of arrival.
+    """
+    def __init__(self, site, max_inflight=ARCHIVE_MAX_INFLIGHT, bulk_inflight=ARCHIVE_BULK_INFLIGHT,
+                 lock_dir=ARCHIVE_SCHEDULER_DIR):
+        self.site = site
+        self.max_inflight = max_inflight
+        self.bulk_inflight = max(min(bulk_inflight, max_inflight), 1)
+        self.lock_dir = lock_dir
+        self._fds = None
+        self._busy = set()
+        self._waiting = []
+        self._tickets = 0
+        self._cond = threading.Condition()
+        self._executor = None
+
+    def _open_slots(self):
+        if not os.path.exists(self.lock_dir):
+            try:
+                os.makedirs(self.lock_dir)
+                # Shared with the other users in the host
+                os.chmod(self.lock_dir, 0o1777)
+            except OSError:
+                if not os.path.isdir(self.lock_dir):
+                    raise
+        # Read-only is enough for flock, and works on files created by others
+        return [os.open(os.path.join(self.lock_dir, '{0}.slot{1}'.format(self.site, n)),
+                        os.O_RDONLY | os.O_CREAT, 0o666)
+                for n in range(self.max_inflight)]
+
+    def _try_slots(self, priority):
+        if self._fds is None:
+            self._fds = self._open_slots()
+        limit = self.bulk_inflight if priority >= PRIORITY_BULK else self.max_inflight
+        for n in range(limit):
+            if n in self._busy:
+                continue
+            try:
+                fcntl.flock(self._fds[n], fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError):
+                # Taken by another process
+                continue
+            self._busy.add(n)
+            return n
+
+    def acquire(self, priority=PRIORITY_INTERACTIVE):
+        "Waits for a free slot and returns it. It must be given back with `release`"
+        with self._cond:
+            ticket = (priority, self._tickets)
+            self._tickets += 1
+            heapq.heappush(self._waiting, ticket)
+            try:
+                delay = 0.005
+                while True:
+                    if self._waiting[0] == ticket:
+                        slot = self._try_slots(priority)
+                        if slot is not None:
+                            return slot
+                    # Slots freed by other processes can't be waited on: poll
+                    self._cond.wait(delay)
+                    delay = min(delay * 2, 0.1)
+            finally:
+                self._waiting.remove(ticket)
+                heapq.heapify(self._waiting)
+                self._cond.notify_all()
+
+    def release(self, slot):
+        with self._cond:
+            fcntl.flock(self._fds[slot], fcntl.LOCK_UN)
+            self._busy.discard(slot)
+            self._cond.notify_all()
+
+    @contextmanager
+    def slot(self, priority=PRIORITY_INTERACTIVE):
+        "Context manager holding a slot for the duration of a request"
+        slot = self.acquire(priority)
+        try:
+            yield slot
+        finally:
+            self.release(slot)
+
+    async def acquire_async(self, priority=PRIORITY_INTERACTIVE):
+        "Like `acquire`, for coroutines. The waiting happens on a separate thread"
+        with self._cond:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_inflight * 2)
+        future = self._executor.submit(self.acquire, priority)
+        try:
+            return await asyncio.wrap_future(future)
+        except asyncio.CancelledError:
+            # If the slot gets acquired anyway, give it back
+            future.add_done_callback(
+                    lambda f: f.cancelled() or f.exception() is not None or self.release(f.result()))
+            raise
+
+_site_schedulers = {}
+_site_schedulers_lock = threading.Lock()
+
+def get_scheduler(site):
+    "Returns the `FetchScheduler` shared by all the exporters for `site` in this process"
+    with _site_schedulers_lock:
+        # Children of a fork must not share the parent's locks
+        key = (site, os.getpid())
+        if key not in _site_schedulers:
+            _site_schedulers[key] = FetchScheduler(site)
+        return _site_schedulers[key]
+
+class PageSizer(object):
+    """
+    Decides the size of each page requested to the archiver. This is the basic
+    policy: ask for `count` samples, over the whole remaining time range.
+
+    After each page, `hook` (if not `None`) is called with a `PageStats` tuple
+    describing the request: `key` (the channel, or a tuple of channels for
+    batched requests), the `start` and `end` of the requested window, the
+    `count` requested, the largest number of `samples` received for a single
+    channel, the total number of `values` (samples times elements per sample)
+    received, the `span` of time covered by those samples and the `latency` of
+    the request, both in seconds.
+    """
+    def __init__(self, count=ARCHIVE_MAX_XMLRPC_SAMPLES, hook=None):
+        self.count = count
+        self.hook = hook
+
+    def next_request(self, key, start, end):
+        "Returns the `(count, window_end)` pair for a page starting at `start`"
+        return self.count, end
+
+    def update(self, stats):
+        if self.hook is not None:
+            self.hook(stats)
+
+class AdaptivePageSizer(PageSizer):
+    """
+    Page sizing policy that learns from the pages already received for each
+    channel (or batch of channels).
+
+    The number of samples per request is chosen so that each page carries
+    around `max_values` values (a 16 element array channel gets smaller pages
+    than a scalar one), within `[min_count, max_count]`. `max_count` is the
+    ceiling and should not exceed what the server is willing to return. If
+    the server takes longer than `max_latency` seconds to answer, the page
+    size is halved, and it is allowed to grow back once answers are faster.
+
+    The observed sample rate is used to bound the time window of each
+    request to the span that the requested count is expected to cover (with
+    some margin), which keeps sparse or intermittent channels from making
+    the server scan long stretches for a page. A page that comes back short
+    means that the channel slowed down or stopped (eg. a gap in the data), so
+    the next request is not bounded, skipping any gap in a single round trip.
+    Windows are used again as soon as a page comes back full.
+    """
+    def __init__(self, count=ARCHIVE_MAX_XMLRPC_SAMPLES, min_count=500,
+                 max_count=ARCHIVE_MAX_XMLRPC_SAMPLES, max_values=100000,
+                 max_latency=5.0, window_margin=2.0, hook=None):
+        super().__init__(count=count, hook=hook)
+        self.min_count = min_count
+        self.max_count = max_count
+        self.max_values = max_values
+        self.max_latency = max_latency
+        self.window_margin = window_margin
+        self._state = {}
+        self._lock = threading.Lock()
+
+    def next_request(self, key, start, end):
+        with self._lock:
+            count, period, short = self._state.get(key, (min(self.count, self.max_count), None, False))
+        if period is None or short:
+            return count, end
+        span = np.timedelta64(int(period * count * self.window_margin), 'ns')
+        return count, min(end, start + span)
+
+    def update(self, stats):
+        with self._lock:
+            previous, period, _ = self._state.get(stats.key, (stats.count, None, False))
+            count = self.max_count
+            if stats.samples > 0:
+                # Size the pages by payload: values per sample, not just samples
+                count = int(self.max_values * stats.samples / stats.values)
+            if stats.samples > 1 and stats.span > 0:
+                new_period = stats.span * 1e9 / (stats.samples - 1)
+                period = new_period if period is None else (period + new_period) / 2
+            if stats.latency > self.max_latency:
+                count = min(count, previous // 2)
+            elif stats.latency * 4 > self.max_latency:
+                count = min(count, previous)
+            else:
+                count = min(count, previous * 2)
+            self._state[stats.key] = (max(self.min_count, min(self.max_count, count)), period,
+                                      stats.samples < stats.count)
+        super().update(stats)
+
 class ArchiveXmlRpcExporter(object):
-    def __init__(self, site):
+    """
+    Retrieves data from the ArchiveDataServer at `site` (one of the keys in
+    `ARCHIVE_SITE_URL`), or at `url`, if it is given explicitly.
+
+    `workers` sets the default number of concurrent connections used by
+    `retrieve`. With `workers > 1` the query is split in time slices that are
+    fetched in parallel (see `parallel_retrieve`).
+
+    With `prefetch`, serial retrieval requests the next page on a background
+    thread while the current one is being consumed.
+
+    All the exporters for the same site share a pool of keep-alive connections
+    (see `get_transport`). `gzip` lets the server compress its responses.
+
+    `sizer` is the `PageSizer` that decides how many samples to ask for in each
+    request. By default, pages of `ARCHIVE_MAX_XMLRPC_SAMPLES` are used.
+
+    Archive keys and channel spans come from the `ArchiveCatalog` for `url`
+    (see `get_catalog`), unless a different `catalog` is given.
+
+    Page requests go through the site's `FetchScheduler` (or `scheduler`),
+    with the given `priority`. Use `PRIORITY_BULK` for long harvests.
+
+    A page request that fails because of the network, or of the server, is
+    tried again up to `retries` times, with exponential backoff. As it asks
+    for the samples after the last one delivered, the retrieval resumes
+    where it stopped.
+    """
+    def __init__(self, site, workers=1, url=None, gzip=True, prefetch=False, sizer=None, catalog=None,
+                 scheduler=None, priority=PRIORITY_INTERACTIVE, retries=ARCHIVE_RETRIES):
         self.site = site
-        self._keys = None
-        self.server = xc.Server(ARCHIVE_SITE_URL[site])
+        self.url = url if url is not None else ARCHIVE_SITE_URL[site]
+        self.workers = workers
+        self.prefetch = prefetch
+        self.sizer = sizer if sizer is not None else PageSizer()
+        self.transport = get_transport(self.url, gzip=gzip)
+        self.catalog = catalog if catalog is not None else get_catalog(site, self.url)
+        self.scheduler = scheduler if scheduler is not None else get_scheduler(site)
+        self.priority = priority
+        self.retries = retries
+        self.server = self._new_server()
+
+    def _new_server(self):
+        return xc.Server(self.url, transport=self.transport)
 
     def get_key(self, source):
-        if self._keys is None:
-            self._keys = dict((x['name'], x['key']) for x in self.server.archiver.archives())
-        return self._keys[source]
-
-    def _partial_retrieve(self, source, channel, start, end):
-        sstart, send = tosecondstimestamp(start), tosecondstimestamp(end)
-        ret = self.server.archiver.values(self.get_key(source), [channel],
-                                          int(sstart), int(sstart - int(sstart))*1000000000,
-                                          int(send), int(send - int(send))*1000000000,
-                                          ARCHIVE_MAX_XMLRPC_SAMPLES, 0)[0]['values']
-        if len(ret) > 0:
-            return [(split_timestamp_to_dt(sample),) + tuple(sample['value']) for sample in ret]
-        else:
-            return []
+        return self.catalog.key(source, self.server)
+
+    def find_archive(self, channel):
+        """
+        Returns the name of the archive holding `channel`. Falls back to guessing
+        it from the name (see `map_pv_to_db`) if the server doesn't know it.
+        """
+        archive = self.catalog.archive_for(channel, self.server)
+        return archive if archive is not None else map_pv_to_db(channel)
+
+    def channel_ranges(self, source, channel=None):
+        """
+        Returns a dictionary mapping the channels in `source` to the
+        `ChannelRange` (first and last timestamps) of their data, and the
+        time at which this was reported by the server.
+        """
+        ranges, updated = self.catalog.ranges(source, self.server, channel)
+        return ranges, np.datetime64(int(updated * 1000000000), 'ns')
+
+    def clip(self, source, channel, start, end):
+        """
+        Narrows `[start, end]` to the span where `channel` has archived data.
+        Returns the new `(start, end)` pair, or `None` if there's no data at
+        all for the query.
+        """
+        ranges, fetched = self.channel_ranges(source, channel)
+        span = ranges.get(channel)
+        start, end = todatetime64(start), todatetime64(end)
+        if span is None or end < span.first:
+            return None
+        # The end of the data is only known for the period before we asked.
+        # After it, the channel may have been archiving new samples
+        if end < fetched - ARCHIVE_RANGE_MARGIN:
+            if start > span.last:
+                return None
+            end = min(end, span.last)
+        return max(start, span.first), end
+
+    def _partial_retrieve_many(self, source, channels, start, end, server=None,
+                               count=ARCHIVE_MAX_XMLRPC_SAMPLES, how=ARCHIVE_HOW_RAW):
+        server = server if server is not None else self.server
+        ssecs, snano = tosecnano(start)
+        esecs, enano = tosecnano(end)
+        key = self.get_key(source)
+        attempt = 0
+        while True:
+            try:
+                with self.scheduler.slot(self.priority), self.transport.unmarshaller(lambda: ValuesParser(count)):
+                    ret = server.archiver.values(key, list(channels),
+                                                 ssecs, snano, esecs, enano,
+                                                 count, how)
+                break
+            except Exception as e:
+                if attempt >= self.retries or not is_transient(e):
+                    raise
+            # Wait without holding the slot
+            sleep(retry_delay(attempt))
+            attempt += 1
+        return dict((channel, decode_block(result))
+                    for (channel, result) in zip(channels, ret))
+
+    def _partial_retrieve(self, source, channel, start, end, server=None,
+                          count=ARCHIVE_MAX_XMLRPC_SAMPLES, how=ARCHIVE_HOW_RAW):
+        return self._partial_retrieve_many(source, [channel], start, end,
+                                           server=server, count=count, how=how)[channel]
 
-    def retrieve(self, source, channel, start, end):
-        t1 = tosecondstimestamp(start)
-        t2 = tosecondstimestamp(end)
-        done = False
+    def _page(self, source, channels, start, end, server=None):
+        """
+        Requests a page of samples for `channels`, starting at `start`, sized
+        according to `self.sizer`. Returns a dictionary mapping each channel to
+        a `(block, next_start)` pair, where `next_start` is `None` if there is
+        nothing left to fetch for that channel.
+        """
+        key = channels[0] if len(channels) == 1 else tuple(channels)
+        count, wend = self.sizer.next_request(key, start, end)
+        t0 = monotonic()
+        result = self._partial_retrieve_many(source, channels, start, wend, server=server, count=count)
+        self.sizer.update(page_stats(key, start, wend, count, result.values(), monotonic() - t0))
+        return dict((channel, (block, next_page_start(block, end, count, wend)))
+                    for (channel, block) in result.items())
+
+    def _retrieve_window(self, source, channel, start, end, server=None):
+        t1 = todatetime64(start)
+        t2 = todatetime64(end)
         latest_timestamp = None
-        while not done:
-            samples = self._partial_retrieve(source, channel, t1, t2)
-            for sample in samples:
-                if latest_timestamp and sample[0] <= latest_timestamp:
-                    continue
-                yield sample
-            if len(samples) < ARCHIVE_MAX_XMLRPC_SAMPLES or tosecondstimestamp(samples[-1][0]) >= t2:
-                done = True
+        while t1 is not None:
+            block, t1 = self._page(source, [channel], t1, t2, server=server)[channel]
+            if len(block) > 0:
+                yield block.after(latest_timestamp)
+                latest_timestamp = block.stamps[-1]
+
+    def _decimated_window(self, source, channel, start, end, decimation):
+        """
+        Requests the bins covering `[start, end]`, in pages of as many bins as
+        the server is allowed to return.
+        """
+        t1, nbins = decimation.bins(start, end)
+        per_page = ARCHIVE_MAX_XMLRPC_SAMPLES // ARCHIVE_SAMPLES_PER_BIN[decimation.mode]
+        latest_timestamp = None
+        while nbins > 0:
+            count = min(nbins, per_page)
+            t2 = t1 + decimation.period * count
+            block = self._partial_retrieve(source, channel, t1, t2, count=count, how=decimation.how)
+            if len(block) > 0:
+                block = block.after(latest_timestamp)
+                if len(block) > 0:
+                    yield block
+                    latest_timestamp = block.stamps[-1]
+            t1 = t2
+            nbins -= count
+
+    def _prefetch_window(self, source, channel, start, end):
+        t2 = todatetime64(end)
+        latest_timestamp = None
+        # The page requests happen on the worker thread, but the key must be
+        # resolved here, as self.server is not thread safe
+        self.get_key(source)
+        server = self._new_server()
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            future = pool.submit(self._page, source, [channel], todatetime64(start), t2, server)
+            try:
+                while future is not None:
+                    block, t1 = future.result()[channel]
+                    # Ask for page k+1 before handing page k to the consumer
+                    if t1 is not None:
+                        future = pool.submit(self._page, source, [channel], t1, t2, server)
+                    else:
+                        future = None
+                    if len(block) > 0:
+                        yield block.after(latest_timestamp)
+                        latest_timestamp = block.stamps[-1]
+            finally:
+                if future is not None:
+                    future.cancel()
+
+    def retrieve_blocks(self, source, channel, start, end, decimation=None):
+        """
+        Like `retrieve`, but yields the samples in `SampleBlock`s (one per page
+        or time slice) instead of one by one.
+        """
+        span = self.clip(source, channel, start, end)
+        if span is None:
+            return iter(())
+        start, end = span
+        if decimation is not None:
+            return self._decimated_window(source, channel, start, end, decimation)
+        elif self.workers > 1:
+            return self.parallel_retrieve(source, channel, start, end, blocks=True)
+        elif self.prefetch:
+            return self._prefetch_window(source, channel, start, end)
+        return self._retrieve_window(source, channel, start, end)
+
+    def retrieve(self, source, channel, start, end, decimation=None):
+        """
+        Yields the samples for `channel` between `start` and `end` as tuples
+        `(stamp, value, ...)`. With a `decimation`, the server reduces the
+        data to bins of the requested width before sending it.
+        """
+        yield from iter_samples(self.retrieve_blocks(source, channel, start, end, decimation))
+
+    def parallel_retrieve(self, source, channel, start, end, workers=None, slices=None, blocks=False):
+        """
+        Splits `[start, end]` in `slices` consecutive windows (by default, as
+        many as `workers`) and fetches them concurrently, using up to `workers`
+        threads, each one with its own connection to the server.
+
+        Samples are yielded in strict timestamp order, as with the serial
+        retrieval. At most `workers` windows are kept in memory at any time.
+        With `blocks=True`, a `SampleBlock` is yielded for each window, instead.
+        """
+        workers = workers if workers is not None else self.workers
+        slices = slices if slices is not None else workers
+        windows = split_window(todatetime64(start), todatetime64(end), slices)
+        # Resolve the archive key before spawning the threads, so that they
+        # don't race to query the archive list
+        self.get_key(source)
+
+        def fetch(wstart, wend, trim):
+            block = SampleBlock.concatenate(
+                    self._retrieve_window(source, channel, wstart, wend, server=self._new_server()))
+            # The server returns the last sample before the window start, which
+            # belongs to the previous window
+            return block.since(wstart) if trim else block
+
+        def ordered():
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                pending = deque(pool.submit(fetch, wstart, wend, n > 0)
+                                for (n, (wstart, wend)) in enumerate(windows[:workers]))
+                queued = iter(windows[workers:])
+                latest_timestamp = None
+                try:
+                    while pending:
+                        block = pending.popleft().result()
+                        following = next(queued, None)
+                        if following is not None:
+                            pending.append(pool.submit(fetch, following[0], following[1], True))
+                        if len(block) > 0:
+                            # Samples at the exact seam are returned by both windows
+                            yield block.after(latest_timestamp)
+                            latest_timestamp = block.stamps[-1]
+                finally:
+                    for future in pending:
+                        future.cancel()
+
+        return ordered() if blocks else iter_samples(ordered())
+
+    def _retrieve_pages_many(self, source, channels, start, end):
+        t2 = todatetime64(end)
+        cursors = OrderedDict()
+        for channel in channels:
+            # Channels with no data in the period are left out of the requests
+            span = self.clip(source, channel, start, end)
+            if span is not None:
+                cursors[channel] = span[0]
+        latest = dict((channel, None) for channel in channels)
+        while cursors:
+            # Channels that are (roughly) at the same point share the request.
+            # The ones that are ahead wait for the rest to catch up
+            t1 = min(cursors.values())
+            batch = [ch for (ch, cursor) in cursors.items()
+                     if cursor - t1 <= ARCHIVE_BATCH_TOLERANCE]
+            result = self._page(source, batch, t1, t2)
+            page = {}
+            for channel in batch:
+                block, cursor = result[channel]
+                page[channel] = block.after(latest[channel])
+                if len(block) > 0:
+                    latest[channel] = block.stamps[-1]
+                if cursor is None:
+                    del cursors[channel]
+                else:
+                    cursors[channel] = cursor
+            yield page
+
+    def retrieve_many(self, source, channels, start, end):
+        """
+        Retrieves a number of `channels` stored in the same `source` archive,
+        fetching all of them in the same request for each page.
+
+        Returns an ordered dictionary mapping each channel to an iterator over
+        its samples, in timestamp order. The iterators share the underlying
+        requests and can be consumed in any order, but samples for the other
+        channels are buffered in memory until they're consumed, so it's better
+        to advance them in step (eg. using `sorted_zip`) for long queries.
+        """
+        channels = list(OrderedDict.fromkeys(channels))
+        pages = self._retrieve_pages_many(source, channels, start, end)
+        buffers = dict((channel, deque()) for channel in channels)
+
+        def stream(channel):
+            buf = buffers[channel]
+            while True:
+                while buf:
+                    yield from buf.popleft()
+                page = next(pages, None)
+                if page is None:
+                    return
+                for ch, block in page.items():
+                    buffers[ch].append(block)
+
+        return OrderedDict((channel, stream(channel)) for channel in channels)
+
+class _AsyncHttpConnection(object):
+    "A keep-alive HTTP/1.1 connection, for `AsyncArchiveXmlRpcExporter`"
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.reusable = True
+
+    def close(self):
+        self.writer.close()
+
+    async def post(self, host, path, body):
+        self.writer.write(
+            'POST {0} HTTP/1.1\r\n'
+            'Host: {1}\r\n'
+            'User-Agent: {2}\r\n'
+            'Content-Type: text/xml\r\n'
+            'Accept-Encoding: gzip\r\n'
+            'Content-Length: {3}\r\n'
+            '\r\n'.format(path, host, xc.Transport.user_agent, len(body)).encode('ascii') + body)
+        await self.writer.drain()
+
+        status_line = await self.reader.readline()
+        if not status_line:
+            raise ConnectionResetError("Connection closed by the server")
+        _, status, reason = (status_line.decode('latin-1').rstrip('\r\n').split(' ', 2) + [''])[:3]
+        headers = {}
+        while True:
+            line = await self.reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int((await self.reader.readline()).split(b';')[0], 16)
+                if size == 0:
+                    await self.reader.readline()
+                    break
+                chunks.append(await self.reader.readexactly(size))
+                await self.reader.readline()
+            data = b''.join(chunks)
+        elif 'content-length' in headers:
+            data = await self.reader.readexactly(int(headers['content-length']))
+        else:
+            data = await self.reader.read()
+            self.reusable = False
+
+        if headers.get('connection', '').lower() == 'close':
+            self.reusable = False
+        if headers.get('content-encoding', '') == 'gzip':
+            data = gzip.decompress(data)
+
+        return int(status), reason, headers, data
+
+class AsyncArchiveXmlRpcExporter(object):
+    """
+    Asyncio counterpart of `ArchiveXmlRpcExporter`. It speaks the same XML-RPC
+    protocol, but over non-blocking connections, so that a single event loop
+    can keep many page requests in flight (eg. retrieving several channels or
+    nights concurrently with `asyncio.gather`).
+
+    `connections` caps the number of simultaneous requests to the server.
+    `url` overrides the server address for `site`, and `sizer` is the
+    `PageSizer` used to decide the size of the requests. Archive keys come
+    from `catalog` (by default, the `ArchiveCatalog` for `url`), and page requests
+    are scheduled by `scheduler` (see `FetchScheduler`) with `priority`.
+    Failed page requests are retried as with the synchronous exporter.
+    """
+    def __init__(self, site, connections=8, url=None, sizer=None, catalog=None,
+                 scheduler=None, priority=PRIORITY_INTERACTIVE, retries=ARCHIVE_RETRIES):
+        self.site = site
+        self.sizer = sizer if sizer is not None else PageSizer()
+        self.url = url if url is not None else ARCHIVE_SITE_URL[site]
+        parsed = urlsplit(self.url)
+        self._host = parsed.hostname
+        self._port = parsed.port or 80
+        self._path = parsed.path or '/'
+        self._netloc = parsed.netloc
+        self.connections = connections
+        self._semaphore = None
+        self._idle = []
+        self.catalog = catalog if catalog is not None else get_catalog(site, self.url)
+        self.scheduler = scheduler if scheduler is not None else get_scheduler(site)
+        self.priority = priority
+        self.retries = retries
+
+    async def _acquire(self):
+        if self._idle:
+            return self._idle.pop(), True
+        reader, writer = await asyncio.open_connection(self._host, self._port)
+        return _AsyncHttpConnection(reader, writer), False
+
+    async def _call(self, method, *params, loads=None):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.connections)
+        body = xc.dumps(params, method).encode('utf-8')
+        async with self._semaphore:
+            while True:
+                conn, reused = await self._acquire()
+                try:
+                    status, reason, headers, data = await conn.post(self._netloc, self._path, body)
+                    break
+                except (OSError, asyncio.IncompleteReadError):
+                    conn.close()
+                    # The server may have dropped an idle connection. Retry
+                    # with a fresh one, but don't insist on new connections
+                    if not reused:
+                        raise
+            if conn.reusable:
+                self._idle.append(conn)
             else:
-                latest_timestamp = samples[-1][0]
-                t1 = addtotimestamp(latest_timestamp, timedelta(microseconds=10))
+                conn.close()
+        if status != 200:
+            raise xc.ProtocolError(self._netloc + self._path, status, reason, headers)
+        return (loads or xc.loads)(data)[0][0]
+
+    async def close(self):
+        "Closes the idle connections to the server"
+        while self._idle:
+            self._idle.pop().close()
+
+    async def get_key(self, source):
+        try:
+            return self.catalog.key(source)
+        except KeyError:
+            self.catalog.set_archives(await self._call('archiver.archives'))
+        return self.catalog.key(source)
+
+    async def _partial_retrieve(self, source, channel, start, end, count=ARCHIVE_MAX_XMLRPC_SAMPLES):
+        ssecs, snano = tosecnano(start)
+        esecs, enano = tosecnano(end)
+        key = await self.get_key(source)
+        attempt = 0
+        while True:
+            slot = await self.scheduler.acquire_async(self.priority)
+            try:
+                ret = await self._call('archiver.values', key, [channel],
+                                       ssecs, snano, esecs, enano,
+                                       count, 0, loads=lambda data: (loads_values(data, count), None))
+                break
+            except Exception as e:
+                if attempt >= self.retries or not is_transient(e):
+                    raise
+            finally:
+                self.scheduler.release(slot)
+            await asyncio.sleep(retry_delay(attempt))
+            attempt += 1
+        return decode_block(ret[0])
+
+    async def _page(self, source, channel, start, end):
+        "Returns a page of samples, and the start of the next one (or `None`)"
+        count, wend = self.sizer.next_request(channel, start, end)
+        t0 = monotonic()
+        samples = await self._partial_retrieve(source, channel, start, wend, count=count)
+        self.sizer.update(page_stats(channel, start, wend, count, [samples], monotonic() - t0))
+        return samples, next_page_start(samples, end, count, wend)
+
+    async def _retrieve_window(self, source, channel, start, end):
+        t1 = todatetime64(start)
+        t2 = todatetime64(end)
+        latest_timestamp = None
+        result = []
+        while t1 is not None:
+            block, t1 = await self._page(source, channel, t1, t2)
+            if len(block) > 0:
+                result.append(block.after(latest_timestamp))
+                latest_timestamp = block.stamps[-1]
+        return SampleBlock.concatenate(result)
+
+    async def retrieve(self, source, channel, start, end, slices=1):
+        """
+        Asynchronous generator yielding the samples for `channel` between
+        `start` and `end`, in timestamp order.
+
+        With `slices > 1`, the query is split in that many windows which are
+        requested concurrently (up to `connections` at a time).
+        """
+        windows = split_window(todatetime64(start), todatetime64(end), slices)
+        if len(windows) == 1:
+            t1, t2 = windows[0]
+            latest_timestamp = None
+            while t1 is not None:
+                block, t1 = await self._page(source, channel, t1, t2)
+                if len(block) > 0:
+                    for sample in block.after(latest_timestamp):
+                        yield sample
+                    latest_timestamp = block.stamps[-1]
+            return
+
+        await self.get_key(source)
+        tasks = [asyncio.ensure_future(self._retrieve_window(source, channel, wstart, wend))
+                 for (wstart, wend) in windows]
+        latest_timestamp = None
+        try:
+            for (n, task) in enumerate(tasks):
+                block = await task
+                # Skip the sample prior to the window start, and the ones
+                # repeated at the seams between windows
+                if n > 0:
+                    block = block.since(windows[n][0])
+                if len(block) > 0:
+                    for sample in block.after(latest_timestamp):
+                        yield sample
+                    latest_timestamp = block.stamps[-1]
+        finally:
+            for task in tasks:
+                task.cancel()
 
 export_header = """\
 # Generated by SWG Export Tools v0.1
@@ -150,17 +1705,179 @@ export_header = """\
 # Data for channel {channel} at {site} follows:
 """
 
+# Binary export files start with this, followed by the length of a JSON
+# header (a little endian uint32), the header itself, and the samples
+EXPORT_MAGIC = b'SWGEXP\x01\x00'
+EXPORT_ALIGNMENT = 16
+# Binary files can also be compressed (the header tells which codec was
+# used). Samples are then stored in independent chunks of, at most,
+# EXPORT_CODEC_CHUNK samples
+EXPORT_CODECS = {
+        'zlib': (zlib.compress, zlib.decompress),
+        'lzma': (lzma.compress, lzma.decompress),
+        }
+EXPORT_CODEC_CHUNK = 65536
+
+def export_dtype(width):
+    "Record type for the samples in a binary export file"
+    return np.dtype([('stamp', '<i8'), ('values', '<f8', (width,))])
+
+def write_binary_export(outfile, blocks, **header):
+    """
+    Writes the samples from an iterable of `SampleBlock`s to the (binary)
+    `outfile`. Each sample is stored as an `int64` timestamp, in nanoseconds,
+    followed by its values as `float64`. The keyword arguments are stored in
+    the file header, along with the width of the samples.
+
+    The header can only be written once the width is known, so the first
+    block is awaited before writing anything.
+    """
+    blocks = iter(blocks)
+    first = next(blocks, None)
+    width = first.width if first is not None else 1
+    write_binary_header(outfile, width, **header)
+    for block in chain([first] if first is not None else [], blocks):
+        write_binary_records(outfile, block, width)
+
+def write_binary_header(outfile, width, **header):
+    header = dict(header, width=width)
+    meta = json.dumps(header).encode('utf-8')
+    # Pad the header so that the records are aligned
+    meta += b' ' * (-(len(EXPORT_MAGIC) + 4 + len(meta)) % EXPORT_ALIGNMENT)
+    outfile.write(EXPORT_MAGIC + len(meta).to_bytes(4, 'little') + meta)
+
+def export_records(block, width):
+    "Returns the samples in `block` as an array of `export_dtype(width)` records"
+    records = np.zeros(len(block), dtype=export_dtype(width))
+    records['stamp'] = block.stamps.astype('datetime64[ns]').view(np.int64)
+    # Samples with a different width (disconnected arrays) are padded or cut
+    common = min(width, block.width)
+    records['values'][:, common:] = np.nan
+    records['values'][:, :common] = block.values[:, :common]
+    return records
+
+def write_binary_records(outfile, block, width):
+    "Appends the samples in `block` to a binary file with samples of `width` values"
+    outfile.write(export_records(block, width).tobytes())
+
+def _shuffle(words):
+    "Groups the bytes of an array of 64 bit words by their significance"
+    return np.ascontiguousarray(words.view(np.uint8).reshape(words.shape + (8,)).T).tobytes()
+
+def _unshuffle(data, shape):
+    planes = np.frombuffer(data, dtype=np.uint8).reshape((8,) + shape[::-1])
+    # Always a copy: the result is decoded in place, and for a single sample
+    # the transposed planes would be a (read only) view of `data`
+    return np.array(planes.T, order='C').view(np.uint64).reshape(shape)
+
+def write_compressed_records(outfile, records, codec):
+    """
+    Appends `records` (see `export_records`) to a compressed binary file,
+    as a single chunk. The timestamps are stored as the differences between
+    consecutive intervals (close to zero for a regularly sampled channel),
+    and each value as its XOR with the previous one (mostly zeros for slowly
+    changing values), before compressing them.
+    """
+    compress = EXPORT_CODECS[codec][0]
+    stamps = records['stamp'].astype(np.int64)
+    deltas = stamps.copy()
+    deltas[1:] = np.diff(stamps)
+    deltas[2:] = np.diff(deltas[1:])
+    values = np.ascontiguousarray(records['values']).view(np.uint64)
+    xored = values.copy()
+    xored[1:] ^= values[:-1]
+    tpart = compress(_shuffle(deltas))
+    vpart = compress(_shuffle(xored))
+    outfile.write(np.array([len(records), len(tpart), len(vpart)], dtype='<u4').tobytes() + tpart + vpart)
+
+def iter_compressed_records(source, width, codec):
+    "Reads the chunks written by `write_compressed_records` from `source`, yielding a `SampleBlock` for each"
+    decompress = EXPORT_CODECS[codec][1]
+    while True:
+        frame = source.read(12)
+        if len(frame) < 12:
+            return
+        count, tlen, vlen = (int(x) for x in np.frombuffer(frame, dtype='<u4'))
+        deltas = _unshuffle(decompress(source.read(tlen)), (count,)).view(np.int64)
+        xored = _unshuffle(decompress(source.read(vlen)), (count, width))
+        deltas[1:] = np.cumsum(deltas[1:])
+        stamps = np.cumsum(deltas)
+        values = np.bitwise_xor.accumulate(xored, axis=0).view(np.float64)
+        yield SampleBlock(stamps.view('datetime64[ns]'), values)
+
+def _read_export_header(path, source):
+    magic = source.read(len(EXPORT_MAGIC))
+    if magic != EXPORT_MAGIC:
+        raise ValueError("{0} is not a binary export file".format(path))
+    length = int.from_bytes(source.read(4), 'little')
+    return json.loads(source.read(length).decode('utf-8')), len(EXPORT_MAGIC) + 4 + length
+
+def iter_export(path):
+    """
+    Yields the samples in a binary export file as `SampleBlock`s: a single
+    memory mapped one for plain files, or one per chunk for compressed ones
+    """
+    with open(path, 'rb') as source:
+        header, offset = _read_export_header(path, source)
+        if header.get('codec') is not None:
+            for block in iter_compressed_records(source, header['width'], header['codec']):
+                yield block
+            return
+    yield load_export(path)[1]
+
+def load_export(path):
+    """
+    Opens a binary export file, returning a `(header, block)` pair. `block`
+    is a `SampleBlock` whose arrays are memory mapped from the file, so no
+    data is actually read until it is accessed. Compressed files are read
+    and decoded at once.
+    """
+    with open(path, 'rb') as source:
+        header, offset = _read_export_header(path, source)
+        if header.get('codec') is not None:
+            # Compressed files can't be mapped
+            return header, SampleBlock.concatenate(
+                    list(iter_compressed_records(source, header['width'], header['codec'])))
+    dtype = export_dtype(header['width'])
+    count = (os.path.getsize(path) - offset) // dtype.itemsize
+    if count == 0:
+        return header, SampleBlock.empty(header['width'])
+    records = np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=(count,))
+    return header, SampleBlock(records['stamp'].view('datetime64[ns]'), records['values'])
+
 # If site is not None, a remote connection is assumed
-def archive_export(system, channel, output, start=None, end=None, site=None, overwrite=False):
+def archive_export(system, channel, output, start=None, end=None, site=None, overwrite=False,
+                   output_format='text', priority=PRIORITY_INTERACTIVE):
+    """
+    Exports the data for `channel` between `start` and `end` to the file `output`.
+    `priority` is used to schedule the requests to `site` (see `FetchScheduler`).
+
+    With `output_format='npy'` the samples are written in binary form (see
+    `write_binary_export`), and can be read back using `load_export`. The
+    default is the text format used by ArchiveExport.
+    """
     if not overwrite and os.path.exists(output):
         return True
 
+    if output_format == 'npy':
+        if site is None:
+            exporter = ArchiveFileExporter(system)
+        else:
+            exporter = ArchiveXmlRpcExporter(site, priority=priority)
+        with open(output, 'wb') as outfile:
+            write_binary_export(outfile, exporter.retrieve_blocks(system, channel, start, end),
+                                channel=channel, site=exporter.site, system=system,
+                                start=isoformat(todatetime64(start)), end=isoformat(todatetime64(end)))
+        return True
+    elif output_format != 'text':
+        raise ValueError("Unknown output format: {0}".format(output_format))
+
     if site is None:
         cmd = ArchiveFileExporter(system).cmd_line_builder(channel, start=start, end=end, output=output)
         return subprocess.call(cmd) == 0
     else:
         with open(output, 'w+') as outfile:
-            exporter = ArchiveXmlRpcExporter(site)
+            exporter = ArchiveXmlRpcExporter(site, priority=priority)
             outfile.write(export_header.format(channel=channel, site=site))
             for sample in exporter.retrieve(system, channel, start, end):
                 outfile.write('\t'.join(tuple(_format_value(x) for x in sample)) + '\n')
@@ -176,6 +1893,23 @@ def tosecondstimestamp(dt):
         return dt.astype(int) / 1000000000.
     return dt
 
+def tosecnano(dt):
+    """
+    Returns the `(seconds, nanoseconds)` pair for a timestamp, as expected by
+    the archiver's XML-RPC calls
+    """
+    return divmod(tonanoseconds(dt), 1000000000)
+
+def tonanoseconds(dt):
+    "Returns a timestamp as an integer number of nanoseconds since the epoch"
+    return int(todatetime64(dt).astype('datetime64[ns]').astype(np.int64))
+
+def todatetime(dt):
+    "Converts a `datetime64` to a `datetime` (with microsecond resolution)"
+    if isinstance(dt, np.datetime64):
+        return dt.astype('datetime64[us]').item()
+    return dt
+
 def todatetime64(dt):
     if isinstance(dt, datetime):
         return np.datetime64(dt, 'ns')
@@ -188,16 +1922,64 @@ def todatetime64(dt):
     # NOTE: Assume that we got a datetime64 instance...
     return dt
 
+# Samples buffered by CacheFile.write before writing them out
+CACHE_WRITE_BUFFER = 4096
+
 class CacheFile(object):
+    """
+    Writes a new segment of cached data. Segments use the same binary format
+    as `write_binary_export`.
+
+    The samples written are expected to come from a single retrieval, with
+    no gaps: when done, all the groups that they touch (or that are touched
+    by the ranges passed to `cover`) are fused in one.
+
+    If the cache manager has a `codec`, the segment is compressed, a chunk
+    of EXPORT_CODEC_CHUNK samples at a time.
+    """
     def __init__(self, cache_manager):
         self._cm = cache_manager
+        self._span = None
         self._file = None
         self._group = None
         self._first = None
         self._last = None
+        self._width = None
+        self._pending = []
+        self._chunk = []
+        self._chunk_size = 0
+
+    def _write_records(self, block):
+        if self._cm.codec is None:
+            write_binary_records(self._file, block, self._width)
+        else:
+            self._chunk.append(export_records(block, self._width))
+            self._chunk_size += len(block)
+            if self._chunk_size >= EXPORT_CODEC_CHUNK:
+                self._flush_chunk()
+
+    def _flush_chunk(self):
+        if self._chunk:
+            records = np.concatenate(self._chunk)
+            for k in range(0, len(records), EXPORT_CODEC_CHUNK):
+                write_compressed_records(self._file, records[k:k + EXPORT_CODEC_CHUNK], self._cm.codec)
+            self._chunk = []
+            self._chunk_size = 0
+
+    def _flush(self):
+        if self._pending:
+            stamps = np.array([todatetime64(stamp) for (stamp, _) in self._pending], dtype='datetime64[ns]')
+            values = values_array([items for (_, items) in self._pending], np.float64)
+            self._write_records(SampleBlock(stamps, values))
+            self._pending = []
 
     def _close_file(self):
         if self._file is not None:
+            self._flush()
+            self._flush_chunk()
+            # The segment must be on disk before it's published
+            self._file.flush()
+            os.fsync(self._file.fileno())
             self._file.close()
             if self._first is not None:
                 self._cm.add_file(self._file.name, self._first, self._last, to_group=self._group)
@@ -209,6 +1991,10 @@ class CacheFile(object):
         self._group = None
         self._first = None
         self._last = None
+        self._width = None
+        self._pending = []
+        self._chunk = []
+        self._chunk_size = 0
 
     def __enter__(self):
         try:
@@ -219,72 +2005,289 @@ class CacheFile(object):
             raise
 
     def __exit__(self, type_, value, traceback):
-        if type_ is None:
-            self._close_file()
+        # Even if the retrieval failed (or was abandoned), the samples written
+        # so far make a complete segment: keep them, so that they don't need
+        # to be fetched again
+        self._close_file()
+        if self._span is not None:
+            self._cm.fuse(*self._span)
+            self._cm.compact(*self._span, min_segments=CACHE_COMPACT_THRESHOLD)
+
+    def _see(self, first, last):
+        first, last = todatetime64(first), todatetime64(last)
+        if self._span is not None:
+            first, last = min(first, self._span[0]), max(last, self._span[1])
+        self._span = (first, last)
+
+    def cover(self, first, last):
+        "Tells that all the data between `first` and `last` has been written"
+        self._see(first, last)
 
     def write(self, stamp, items):
-        # TODO:
-        # This algorithm is not too thorough. It will detect when a new set of entries overlap with
-        # existing interval groups with start <= of the current stamp, and will include the resulting
-        # new file inside said existing group, but it won't fuse two high level groups if the new
-        # data stream spans both. This would need additional support on the cache manager class
+        self._see(stamp, stamp)
         group = self._cm.get_interval_for_stamp(stamp)
         if group is None:
-            b1 = bytes('\t'.join([isoformat(stamp)] + ["{0:.9f}".format(i) for i in items]) + '\n', encoding='utf-8')
-            self._file.write(b1)
+            if self._width is None:
+                self._start_segment(len(items))
+            self._pending.append((stamp, list(items)))
+            if len(self._pending) >= CACHE_WRITE_BUFFER:
+                self._flush()
             if self._first is None:
                 self._first = stamp
             self._last = stamp
-        elif self._group != group:
+        else:
+            self._enter_group(group)
+
+    def write_block(self, stamps, values):
+        """
+        Writes a block of samples: `stamps` is an array of timestamps, and
+        `values` a 2-D array with one row per sample. The effect is the same
+        as calling `write` for each sample, but the overlap with the cached
+        groups is checked for the whole block at once, and the samples are
+        written in one go.
+        """
+        if len(stamps) == 0:
+            return
+        stamps = np.asarray(stamps, dtype='datetime64[ns]')
+        self._see(stamps[0], stamps[-1])
+        if not self._cm.overlaps(stamps[0], stamps[-1]):
+            self._append(stamps, values)
+            return
+        # Split the block in runs of samples in the same group (or in none)
+        groups = self._cm.find_intervals(stamps)
+        edges = list(np.flatnonzero(np.diff(groups)) + 1)
+        for first, last in zip([0] + edges, edges + [len(stamps)]):
+            if groups[first] < 0:
+                self._append(stamps[first:last], values[first:last])
+            else:
+                self._enter_group(self._cm.interval_at(groups[first]))
+
+    def _start_segment(self, width):
+        self._width = width
+        write_binary_header(self._file, self._width, channel=self._cm.pvname,
+                            site=self._cm.site, db=self._cm.db, kind=self._cm.kind,
+                            codec=self._cm.codec)
+
+    def _append(self, stamps, values):
+        if self._width is None:
+            self._start_segment(values.shape[1])
+        self._flush()
+        self._write_records(SampleBlock(stamps, values))
+        if self._first is None:
+            self._first = stamps[0]
+        self._last = stamps[-1]
+
+    def _enter_group(self, group):
+        if self._group != group:
             if self._group is not None:
                 self._close_file()
                 self._reset_file()
             self._group = group
 
-class CacheJsonEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, np.datetime64):
-            return tosecondstimestamp(obj)
-
 IntervalIndexEntry = namedtuple('IntervalIndexEntry', 'start end files')
 RawIndexEntry = namedtuple('RawIndexEntry', 'start end name')
 
+# The index of each cache directory is kept in a SQLite database. Timestamps
+# are stored as integer nanoseconds since the epoch
+CACHE_INDEX_NAME = 'index.sqlite'
+# Old caches kept the index in a JSON file. It is imported the first time
+# the cache is opened
+CACHE_LEGACY_INDEX_NAME = 'index.txt'
+# Seconds to wait for other processes updating the index
+CACHE_INDEX_TIMEOUT = 60
+# Processes sharing a cache directory coordinate through a lock file on it.
+# Segments are written to temporary files, starting with CACHE_PARTIAL_PREFIX,
+# and renamed when they're published
+CACHE_LOCK_NAME = 'index.lock'
+CACHE_PARTIAL_PREFIX = '.partial-'
+# Temporary files older than this (in seconds) were left behind by a crash
+CACHE_PARTIAL_MAX_AGE = 86400
+# Compaction rewrites runs of segments smaller than half CACHE_SEGMENT_BYTES
+# into segments of up to CACHE_SEGMENT_BYTES. It runs on its own on groups
+# that have accumulated CACHE_COMPACT_THRESHOLD of those small segments
+CACHE_SEGMENT_BYTES = 32 * 1024 * 1024
+CACHE_COMPACT_THRESHOLD = 16
+CACHE_INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS groups (
+    id INTEGER PRIMARY KEY,
+    start_ns INTEGER NOT NULL,
+    end_ns INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS groups_by_start ON groups (start_ns);
+CREATE TABLE IF NOT EXISTS segments (
+    name TEXT PRIMARY KEY,
+    grp INTEGER NOT NULL REFERENCES groups (id),
+    start_ns INTEGER NOT NULL,
+    end_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL DEFAULT 0,
+    atime REAL NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS segments_by_group ON segments (grp);
+"""
+# The time a segment was last read is only updated if it's older than this
+# (in seconds), to avoid writing to the index on every read
+CACHE_ATIME_RESOLUTION = 3600
+# File in the root of a cache with the time ranges that must not be evicted
+CACHE_PINS_NAME = 'pins.cfg'
+
 class RawCacheManager(object):
-    def __init__(self, root_dir, site, db, pvname):
+    """
+    Keeps track of the data cached for `pvname`. `kind` separates the raw
+    data from each of the decimated versions of it (see `Decimation.cache_name`).
+    New segments are compressed with `codec` (one of `EXPORT_CODECS`), if
+    given. Segments written with and without compression can be mixed.
+
+    The cached segments are grouped in non-overlapping intervals. The index
+    is kept in a SQLite database, so that adding a segment is a single
+    transaction, and queries only load the groups they need.
+
+    Groups known to be contiguous are fused, and their small segments are
+    rewritten as bigger ones from time to time (see `compact`), so that the
+    cache doesn't get slower to read as it grows.
+
+    Several processes can share the same cache. Segments are written apart
+    and published (renamed and added to the index) holding an exclusive lock
+    on the cache directory, while lookups hold a shared one. A process
+    fetching data doesn't hold any lock until it's done with a segment.
+    """
+    def __init__(self, root_dir, site, db, pvname, kind='raw', codec=None):
+        if codec is not None and codec not in EXPORT_CODECS:
+            raise ValueError("Unknown codec: {0}".format(codec))
         self.root = root_dir
         self.site = site
         self.db = db
         self.pvname = pvname
-        self.cache_dir = os.path.join(root_dir, site, db, pvname, 'raw')
-        self._intervals = None
+        self.kind = kind
+        self.codec = codec
+        self.cache_dir = os.path.join(root_dir, site, db, pvname, kind)
+        self._index = None
+        self._groups = {}
+        self._bounds = None
+        self._atimes = {}
+        self._lock_file = None
+        self._lock_depth = 0
+        self._lock_exclusive = False
+        self._rewriting = False
 
     def __contains__(self, stamp):
         return self.get_interval_for_stamp(stamp) is not None
 
     @property
-    def cache_file(self):
-        return os.path.join(self.cache_dir, 'index.txt')
-
-    def dump_index(self, intervals):
-        if intervals is not None:
-            json.dump(
-                    fp=open(self.cache_file, 'w'),
-                    cls=CacheJsonEncoder,
-                    indent=2,
-                    obj=[{"_comment": "Data {0} - {1}".format(isoformat(g.start), isoformat(g.end)),
-                          "start": g.start,
-                          "end": g.end,
-                          "files": [{"name": os.path.basename(i.name),
-                                     "start": i.start,
-                                     "end": i.end}
-                                    for i in g.files]}
-                         for g in intervals]
-                    )
-
-    def load_index(self):
+    def index_file(self):
+        return os.path.join(self.cache_dir, CACHE_INDEX_NAME)
+
+    @property
+    def legacy_index_file(self):
+        return os.path.join(self.cache_dir, CACHE_LEGACY_INDEX_NAME)
+
+    @property
+    def lock_file(self):
+        return os.path.join(self.cache_dir, CACHE_LOCK_NAME)
+
+    @contextmanager
+    def locked(self, exclusive=False):
+        """
+        Holds the lock on the cache directory, shared (for lookups) or
+        exclusive (to publish or remove segments). The lock can be taken
+        again while held, but a shared lock can't be made exclusive.
+        """
+        if self._lock_depth == 0:
+            if not os.path.exists(self.cache_dir):
+                if not exclusive:
+                    # Nothing cached yet: nothing to protect
+                    yield
+                    return
+                os.makedirs(self.cache_dir, exist_ok=True)
+            lock_file = open(self.lock_file, 'a')
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            except BaseException:
+                lock_file.close()
+                raise
+            self._lock_file = lock_file
+            self._lock_exclusive = exclusive
+        elif exclusive and not self._lock_exclusive:
+            raise RuntimeError("Can't upgrade a shared lock on {0}".format(self.cache_dir))
+        self._lock_depth += 1
+        try:
+            yield
+        finally:
+            self._lock_depth -= 1
+            if self._lock_depth == 0:
+                # Closing the file releases the lock
+                self._lock_file.close()
+                self._lock_file = None
+
+    def forget(self):
+        "Drops what's known about the index, so that it's read again"
+        self._groups = {}
+        self._bounds = None
+
+    def close(self):
+        if self._index is not None:
+            self._index.close()
+            self._index = None
+
+    def _connect(self, create=False):
+        """
+        Returns the connection to the index database, or `None` if there's
+        no index yet and `create` is false.
+        """
+        if self._index is None:
+            if not os.path.exists(self.index_file):
+                if not (create or os.path.exists(self.legacy_index_file)):
+                    return None
+                os.makedirs(self.cache_dir, exist_ok=True)
+            # Autocommit mode: transactions are started explicitly
+            self._index = sqlite3.connect(self.index_file, timeout=CACHE_INDEX_TIMEOUT, isolation_level=None)
+            self._index.executescript(CACHE_INDEX_SCHEMA)
+            if 'atime' not in self._segment_columns():
+                self._add_segment_stats()
+            if os.path.exists(self.legacy_index_file):
+                self._import_legacy_index()
+        return self._index
+
+    @contextmanager
+    def _transaction(self):
+        index = self._connect(create=True)
+        index.execute('BEGIN IMMEDIATE')
+        try:
+            yield index
+        except BaseException:
+            index.execute('ROLLBACK')
+            raise
+        else:
+            index.execute('COMMIT')
+        finally:
+            self.forget()
+
+    def _segment_columns(self):
+        return set(row[1] for row in self._index.execute('PRAGMA table_info(segments)'))
+
+    def _segment_stats(self, name):
+        "Returns the size and modification time of a segment"
+        try:
+            st = os.stat(os.path.join(self.cache_dir, name))
+            return st.st_size, st.st_mtime
+        except OSError:
+            return 0, 0
+
+    def _add_segment_stats(self):
+        "Adds the size and access time of the segments to an index created before they were tracked"
+        with self._transaction() as index:
+            # Someone else may have done it already
+            if 'atime' not in self._segment_columns():
+                index.execute('ALTER TABLE segments ADD COLUMN size INTEGER NOT NULL DEFAULT 0')
+                index.execute('ALTER TABLE segments ADD COLUMN atime REAL NOT NULL DEFAULT 0')
+                names = [name for (name,) in index.execute('SELECT name FROM segments')]
+                index.executemany('UPDATE segments SET size = ?, atime = ? WHERE name = ?',
+                                  [self._segment_stats(name) + (name,) for name in names])
+
+    def load_legacy_index(self):
+        "Returns the interval groups recorded in an old style JSON index"
         try:
             result = []
-            for group in json.load(open(self.cache_file)):
+            for group in json.load(open(self.legacy_index_file)):
                 result.append(
                         IntervalIndexEntry(
                             start=todatetime64(group['start']),
@@ -299,32 +2302,121 @@ class RawCacheManager(object):
         except (IOError, OSError):
             return []
 
+    def _import_legacy_index(self):
+        with self._transaction() as index:
+            # Someone else may have done it already
+            if index.execute('SELECT count(*) FROM groups').fetchone()[0] == 0:
+                for group in self.load_legacy_index():
+                    gid = index.execute('INSERT INTO groups (start_ns, end_ns) VALUES (?, ?)',
+                                        (tonanoseconds(group.start), tonanoseconds(group.end))).lastrowid
+                    index.executemany('INSERT OR REPLACE INTO segments (name, grp, start_ns, end_ns, size, atime)'
+                                      ' VALUES (?, ?, ?, ?, ?, ?)',
+                                      [(os.path.basename(f.name), gid, tonanoseconds(f.start), tonanoseconds(f.end))
+                                       + self._segment_stats(os.path.basename(f.name))
+                                       for f in group.files])
+        try:
+            os.rename(self.legacy_index_file, self.legacy_index_file + '.old')
+        except OSError:
+            pass
+
+    def _select_groups(self, condition='1', params=()):
+        """
+        Returns the interval groups matching the SQL `condition` (on the
+        `groups` table, aliased as `g`), sorted by their start
+        """
+        index = self._connect()
+        if index is None:
+            return []
+        rows = index.execute('SELECT g.id, g.start_ns, g.end_ns, s.name, s.start_ns, s.end_ns, s.atime'
+                             '  FROM groups AS g JOIN segments AS s ON s.grp = g.id'
+                             ' WHERE ' + condition +
+                             ' ORDER BY g.start_ns, g.end_ns, g.id, s.start_ns, s.end_ns, s.name', params)
+        result = []
+        for (gid, start, end), files in groupby(rows, key=lambda row: row[:3]):
+            files = list(files)
+            self._atimes.update((name, atime) for (_, _, _, name, _, _, atime) in files)
+            entry = IntervalIndexEntry(start=np.datetime64(start, 'ns'),
+                                       end=np.datetime64(end, 'ns'),
+                                       files=tuple(RawIndexEntry(start=np.datetime64(fstart, 'ns'),
+                                                                 end=np.datetime64(fend, 'ns'),
+                                                                 name=name)
+                                                   for (_, _, _, name, fstart, fend, _) in files))
+            self._groups[gid] = entry
+            result.append(entry)
+        return result
+
     def get_intervals(self, refresh):
-        if self._intervals is None or refresh:
-            try:
-                self._intervals = self.load_index()
-            except (IOError, OSError):
-                # Possibly, no cache file
-                pass
-        return self._intervals or []
+        "Returns all the interval groups. Prefer `get_intersection` to look at a range"
+        if refresh:
+            self.forget()
+        with self.locked():
+            return self._select_groups()
+
+    def _interval_bounds(self):
+        "Returns arrays with the ids, start and end points of the groups, sorted by start"
+        if self._bounds is None:
+            with self.locked():
+                index = self._connect()
+                rows = [] if index is None else index.execute(
+                        'SELECT id, start_ns, end_ns FROM groups ORDER BY start_ns, end_ns').fetchall()
+            table = np.array(rows, dtype=np.int64).reshape(-1, 3)
+            self._bounds = (table[:,0],
+                            table[:,1].astype('datetime64[ns]'),
+                            table[:,2].astype('datetime64[ns]'))
+        return self._bounds
+
+    def interval_at(self, pos):
+        "Returns the interval group at position `pos` (as given by `find_intervals`)"
+        gid = int(self._interval_bounds()[0][pos])
+        if gid not in self._groups:
+            with self.locked():
+                self._select_groups('g.id = ?', (gid,))
+        return self._groups[gid]
+
+    def find_intervals(self, stamps):
+        """
+        For each timestamp in the array `stamps`, returns the position of the
+        interval group containing it (see `interval_at`), or -1 if the stamp
+        is not cached.
+        """
+        ids, starts, ends = self._interval_bounds()
+        stamps = np.asarray(stamps, dtype='datetime64[ns]')
+        if len(ids) == 0:
+            return np.full(stamps.shape, -1, dtype=np.intp)
+        # Groups don't overlap: the only candidate is the last one starting
+        # at, or before, each stamp
+        pos = np.searchsorted(starts, stamps, side='right') - 1
+        found = (pos >= 0) & (stamps <= ends[np.maximum(pos, 0)])
+        return np.where(found, pos, -1)
+
+    def overlaps(self, first, last):
+        "Tells if any of the interval groups intersects `[first, last]`"
+        ids, starts, ends = self._interval_bounds()
+        # Groups starting before `last`, minus the ones that end before `first`
+        return np.searchsorted(starts, last, side='right') > np.searchsorted(ends, first, side='left')
 
     def get_interval_for_stamp(self, stamp, raw=False):
-        for group in self.get_intervals(refresh=False):
-            if group.start <= stamp <= group.end:
-                return group
+        ids, starts, ends = self._interval_bounds()
+        stamp = np.datetime64(todatetime64(stamp), 'ns')
+        pos = int(np.searchsorted(starts, stamp, side='right')) - 1
+        if pos >= 0 and stamp <= ends[pos]:
+            return self.interval_at(pos)
 
     def get_intersection(self, start, end, refresh=False):
-        result = []
-        # Intervals are non-overlapping and sorted by (start, end) points, so the
-        # condition for takewhile should work
-        for interval in takewhile(lambda x: (x.start <= end and x.end >= start), self.get_intervals(refresh)):
-            c1 = interval.start <= start <= interval.end
-            c2 = interval.start <= end <= interval.end
-            c3 = start <= interval.start and interval.end <= end
-            if c1 or c2 or c3:
-                result.append(interval)
-
-        return result
+        """
+        Returns the interval groups intersecting `[start, end]`, sorted by
+        their start
+        """
+        if refresh:
+            self.forget()
+        # Groups don't overlap, so the earliest candidate is the last one
+        # starting at, or before, `start`. This keeps the scan on the index
+        # within the range
+        with self.locked():
+            return self._select_groups(
+                    'g.start_ns <= :end AND g.end_ns >= :start AND g.start_ns >= '
+                    '(SELECT coalesce(max(start_ns), :start) FROM groups WHERE start_ns <= :start)',
+                    {'start': tonanoseconds(start), 'end': tonanoseconds(end)})
 
     def get_difference(self, start, end, refresh=False):
         intersec = self.get_intersection(start, end, refresh)
@@ -363,44 +2455,527 @@ class RawCacheManager(object):
 
     def create_temp_file(self):
         if not os.path.exists(self.cache_dir):
-            os.makedirs(self.cache_dir)
-        return tempfile.NamedTemporaryFile(dir=self.cache_dir, delete=False)
+            os.makedirs(self.cache_dir, exist_ok=True)
+        return tempfile.NamedTemporaryFile(dir=self.cache_dir, prefix=CACHE_PARTIAL_PREFIX, delete=False)
 
     def add_to_index(self, path, start, end, to_group=None):
-        # TODO: This function should make sure that the intervals do not overlap
-        #       but we're going to assume it so far.
-        new_entry = RawIndexEntry(name=path, start=start, end=end)
-        interval_set = set(self.get_intervals(refresh=False))
+        """
+        Records the segment at `path`, spanning `[start, end]`, as part of the
+        interval group `to_group`, or of a new group if it's `None`
+        """
+        # Overlaps are not checked here: `add_file` rewrites the segment
+        # without the samples that are already cached (see `_conflicts`)
+        # before adding it, holding the exclusive lock
+        start, end = tonanoseconds(start), tonanoseconds(end)
+        with self._transaction() as index:
+            gid = None
+            if to_group is not None:
+                row = index.execute('SELECT id FROM groups WHERE start_ns <= :start AND end_ns >= :start',
+                                    {'start': tonanoseconds(to_group.start)}).fetchone()
+                if row is not None:
+                    gid = row[0]
+                    index.execute('UPDATE groups SET start_ns = min(start_ns, ?), end_ns = max(end_ns, ?)'
+                                  ' WHERE id = ?', (start, end, gid))
+            if gid is None:
+                gid = index.execute('INSERT INTO groups (start_ns, end_ns) VALUES (?, ?)', (start, end)).lastrowid
+            index.execute('INSERT OR REPLACE INTO segments (name, grp, start_ns, end_ns, size, atime)'
+                          ' VALUES (?, ?, ?, ?, ?, ?)',
+                          (os.path.basename(path), gid, start, end, self._segment_stats(path)[0], time()))
 
-        if to_group is None:
-            new_group = IntervalIndexEntry(start=start, end=end, files=(new_entry,))
-        else:
-            new_files = files=tuple(sorted(to_group.files + (new_entry,)))
-            new_group = IntervalIndexEntry(start=min(f.start for f in new_files),
-                                           end=max(f.end for f in new_files),
-                                           files=tuple(sorted(to_group.files + (new_entry,))))
-            interval_set.remove(to_group)
-        interval_set.add(new_group)
-        self._intervals = sorted(interval_set)
-        self.dump_index(self._intervals)
+    def _conflicts(self, start, end, to_group):
+        "Tells if publishing `[start, end]` into `to_group` would overlap other groups"
+        group = None
+        if to_group is not None:
+            group = self.get_interval_for_stamp(to_group.start)
+        if group is not None:
+            start, end = min(start, group.start), max(end, group.end)
+        return any(other != group for other in self.get_intersection(start, end))
 
     def add_file(self, path, start, end, is_temp=True, to_group=None):
-        if is_temp:
-            newfn = self.get_file_name(start, end, full_path=True)
-            os.rename(path, newfn)
-            path = newfn
-        self.add_to_index(path, start, end, to_group=to_group)
+        """
+        Publishes the segment at `path`, spanning `[start, end]`, as part of
+        the interval group `to_group` (or of a new one). A temporary segment
+        is first renamed to its final name, and then added to the index, so
+        that the index never points to an incomplete file.
 
-    def iterate_index(self, index_entry):
+        Other processes may have cached part of the same range while this
+        segment was being written. In that case, only the samples that are
+        still missing are kept, written again as new segments.
+        """
+        start, end = todatetime64(start), todatetime64(end)
+        with self.locked(exclusive=True):
+            self.forget()
+            if is_temp and not self._rewriting and self._conflicts(start, end, to_group):
+                block = self.read_segment(path)
+                os.remove(path)
+                self._rewriting = True
+                try:
+                    with self.new_file() as dest:
+                        dest.write_block(block.stamps, block.values)
+                finally:
+                    self._rewriting = False
+                return
+            if is_temp:
+                newfn = self.get_file_name(start, end, full_path=True)
+                os.replace(path, newfn)
+                path = newfn
+            self.add_to_index(path, start, end, to_group=to_group)
+
+    def _merge_groups(self, index, ids):
+        "Merges the groups `ids` into the first of them. Must run within a transaction"
+        if len(ids) > 1:
+            keep, others = ids[0], ids[1:]
+            marks = ', '.join('?' * len(others))
+            index.execute('UPDATE groups SET'
+                          ' start_ns = (SELECT min(start_ns) FROM groups WHERE id IN (?, {0})),'
+                          ' end_ns = (SELECT max(end_ns) FROM groups WHERE id IN (?, {0}))'
+                          ' WHERE id = ?'.format(marks), [keep] + others + [keep] + others + [keep])
+            index.execute('UPDATE segments SET grp = ? WHERE grp IN ({0})'.format(marks), [keep] + others)
+            index.execute('DELETE FROM groups WHERE id IN ({0})'.format(marks), others)
+
+    def fuse(self, first, last):
+        """
+        Merges all the groups intersecting `[first, last]`, a range known to
+        be cached with no gaps (eg. because it was retrieved in one go)
+        """
+        with self.locked(exclusive=True):
+            if self._connect() is None:
+                return
+            with self._transaction() as index:
+                ids = [gid for (gid,) in index.execute(
+                        'SELECT id FROM groups WHERE start_ns <= ? AND end_ns >= ? ORDER BY start_ns',
+                        (tonanoseconds(last), tonanoseconds(first)))]
+                self._merge_groups(index, ids)
+
+    def segment_width(self, name):
+        "Returns the number of values per sample in a segment, reading only its header"
+        path = os.path.join(self.cache_dir, name)
+        with open(path, 'rb') as source:
+            if source.read(len(EXPORT_MAGIC)) == EXPORT_MAGIC:
+                source.seek(0)
+                return _read_export_header(path, source)[0]['width']
+            source.seek(0)
+            for line in source:
+                if line.split():
+                    return len(line.split()) - 1
+        return 0
+
+    def _segment_runs(self, rows):
+        """
+        Splits the segments in `rows` (a group's `(name, start_ns, end_ns, size)`,
+        sorted by start) in runs that are worth rewriting as a single segment:
+        consecutive small ones, plus any that overlap the previous ones.
+        Returns a list of lists of segment names. Only the headers of the
+        segments are read.
+        """
+        runs = []
+        for (name, start, end, size) in rows:
+            small = size < CACHE_SEGMENT_BYTES // 2
+            last = runs[-1] if runs else None
+            # Big segments only take others in to get rid of duplicates
+            joins = last is not None and (
+                        start <= last['end'] or
+                        (small and last['small'] and last['size'] + size <= CACHE_SEGMENT_BYTES))
+            width = self.segment_width(name) if joins or small else None
+            if joins and width == last['width']:
+                last['names'].append(name)
+                last['size'] += size
+                last['end'] = max(last['end'], end)
+                last['small'] = last['small'] and small
+            else:
+                runs.append({'names': [name], 'width': width, 'size': size, 'end': end, 'small': small})
+        return [run['names'] for run in runs if len(run['names']) > 1]
+
+    def _write_segments(self, block):
+        """
+        Writes the samples in `block` to temporary segments of (at most)
+        CACHE_SEGMENT_BYTES each, and returns their paths, with the time
+        ranges covered
+        """
+        result = []
+        step = max(CACHE_SEGMENT_BYTES // export_dtype(block.width).itemsize, 1)
+        for k in range(0, len(block), step):
+            piece = block[k:k + step]
+            with self.create_temp_file() as dest:
+                write_binary_header(dest, block.width, channel=self.pvname,
+                                    site=self.site, db=self.db, kind=self.kind, codec=self.codec)
+                if self.codec is None:
+                    write_binary_records(dest, piece, block.width)
+                else:
+                    records = export_records(piece, block.width)
+                    for n in range(0, len(records), EXPORT_CODEC_CHUNK):
+                        write_compressed_records(dest, records[n:n + EXPORT_CODEC_CHUNK], self.codec)
+                dest.flush()
+                os.fsync(dest.fileno())
+            result.append((dest.name, piece.stamps[0], piece.stamps[-1]))
+        return result
+
+    def _unused_name(self, start, end):
+        name = self.get_file_name(start, end)
+        candidate, n = name, 0
+        while os.path.exists(os.path.join(self.cache_dir, candidate)):
+            n += 1
+            candidate = '{0}.{1}'.format(name, n)
+        return candidate
+
+    def _rewrite_run(self, run):
+        "Replaces the segments named in `run` with new ones, without duplicated samples"
+        # Segments are read holding a shared lock only, so that other
+        # readers can go on
+        with self.locked():
+            try:
+                block = SampleBlock.concatenate([self.read_segment(name) for name in run])
+            except FileNotFoundError:
+                # Compacted or evicted meanwhile
+                return 0
+        order = np.argsort(block.stamps, kind='stable')
+        stamps = block.stamps[order]
+        keep = np.ones(len(stamps), dtype=bool)
+        keep[1:] = stamps[1:] != stamps[:-1]
+        written = self._write_segments(SampleBlock(stamps[keep], block.values[order][keep]))
+        old = list(run)
+        # Publish the new segments, unless the old ones changed meanwhile
+        with self.locked(exclusive=True):
+            marks = ', '.join('?' * len(old))
+            groups = set(gid for (gid,) in self._index.execute(
+                                'SELECT grp FROM segments WHERE name IN ({0})'.format(marks), old))
+            rows = self._index.execute('SELECT count(*) FROM segments WHERE name IN ({0})'.format(marks), old)
+            if len(groups) != 1 or rows.fetchone()[0] != len(old):
+                for (path, _, _) in written:
+                    os.remove(path)
+                return 0
+            gid = groups.pop()
+            # The new segments are as recently used as the old ones
+            atime = self._index.execute('SELECT max(atime) FROM segments WHERE name IN ({0})'.format(marks),
+                                        old).fetchone()[0]
+            new = []
+            for (path, start, end) in written:
+                name = self._unused_name(start, end)
+                os.replace(path, os.path.join(self.cache_dir, name))
+                new.append((name, gid, tonanoseconds(start), tonanoseconds(end),
+                            self._segment_stats(name)[0], atime))
+            with self._transaction() as index:
+                index.execute('DELETE FROM segments WHERE name IN ({0})'.format(marks), old)
+                index.executemany('INSERT INTO segments (name, grp, start_ns, end_ns, size, atime)'
+                                  ' VALUES (?, ?, ?, ?, ?, ?)', new)
+            for name in old:
+                try:
+                    os.remove(os.path.join(self.cache_dir, name))
+                except FileNotFoundError:
+                    pass
+        return len(old)
+
+    def compact(self, start=None, end=None, min_segments=2):
+        """
+        Compacts the cache between `start` and `end` (by default, all of it).
+        Groups that overlap or touch each other are merged, and, for groups
+        with at least `min_segments` small segments, runs of small or
+        overlapping segments are rewritten as bigger ones, dropping duplicated
+        samples. Compacting the whole cache also rewrites the groups with
+        overlapping segments, whatever their size. Returns the number of
+        segments that were replaced.
+
+        New data is compacted automatically, when a group reaches
+        CACHE_COMPACT_THRESHOLD small segments.
+        """
+        first = np.iinfo(np.int64).min if start is None else tonanoseconds(start)
+        last = np.iinfo(np.int64).max if end is None else tonanoseconds(end)
+        with self.locked(exclusive=True):
+            if self._connect() is None:
+                return 0
+            with self._transaction() as index:
+                rows = index.execute('SELECT id, start_ns, end_ns FROM groups'
+                                     ' WHERE start_ns <= ? AND end_ns >= ? ORDER BY start_ns, end_ns',
+                                     (last, first)).fetchall()
+                merged, gend = [], None
+                for (gid, gstart, gfinish) in rows:
+                    if merged and gstart <= gend:
+                        merged[-1].append(gid)
+                        gend = max(gend, gfinish)
+                    else:
+                        merged.append([gid])
+                        gend = gfinish
+                for ids in merged:
+                    self._merge_groups(index, ids)
+                groups = ', '.join(str(ids[0]) for ids in merged) or 'NULL'
+                candidates = set(gid for (gid, count) in index.execute(
+                                    'SELECT grp, sum(size < ?) FROM segments WHERE grp IN ({0})'
+                                    ' GROUP BY grp'.format(groups), (CACHE_SEGMENT_BYTES // 2,))
+                                 if count >= min_segments)
+                if start is None and end is None:
+                    candidates.update(gid for (gid,) in index.execute(
+                        'SELECT DISTINCT a.grp FROM segments AS a JOIN segments AS b'
+                        '    ON a.grp = b.grp AND a.name < b.name'
+                        '   AND a.start_ns <= b.end_ns AND b.start_ns <= a.end_ns'
+                        ' WHERE a.grp IN ({0})'.format(groups)))
+            if start is None and end is None:
+                self._sweep()
+        replaced = 0
+        for gid in sorted(candidates):
+            with self.locked():
+                rows = self._index.execute('SELECT name, start_ns, end_ns, size FROM segments'
+                                           ' WHERE grp = ? ORDER BY start_ns, end_ns, name', (gid,)).fetchall()
+                runs = self._segment_runs(rows)
+            for run in runs:
+                replaced += self._rewrite_run(run)
+        return replaced
+
+    def _sweep(self):
+        """
+        Removes the segments that are not in the index, and the temporary
+        files left behind by writers that crashed. Must hold the exclusive lock
+        """
+        indexed = set(name for (name,) in self._index.execute('SELECT name FROM segments'))
+        now = time()
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if name.startswith(CACHE_PARTIAL_PREFIX):
+                if now - os.path.getmtime(path) < CACHE_PARTIAL_MAX_AGE:
+                    continue
+            elif name in indexed or name.startswith('index.'):
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def touch(self, names):
+        "Records that the segments `names` have just been read"
+        now = time()
+        stale = [name for name in names if now - self._atimes.get(name, 0) >= CACHE_ATIME_RESOLUTION]
+        if stale and self._connect() is not None:
+            try:
+                self._index.execute('UPDATE segments SET atime = ? WHERE name IN ({0})'.format(
+                                        ', '.join('?' * len(stale))), [now] + stale)
+            except sqlite3.OperationalError:
+                # Eg. a read-only cache. Not worth failing the read for it
+                return
+            self._atimes.update((name, now) for name in stale)
+
+    def segments(self):
+        "Returns a list of `(name, start_ns, end_ns, size, atime)` for all the cached segments"
+        with self.locked():
+            if self._connect() is None:
+                return []
+            return self._index.execute('SELECT name, start_ns, end_ns, size, atime FROM segments').fetchall()
+
+    def evict(self, names):
+        """
+        Removes the segments `names` from the cache, and returns the number
+        of bytes freed. Groups losing segments are shrunk, or split, so that
+        they only span data that is still cached.
+        """
+        freed = 0
+        with self.locked(exclusive=True):
+            if not names or self._connect() is None:
+                return 0
+            with self._transaction() as index:
+                marks = ', '.join('?' * len(names))
+                rows = index.execute('SELECT name, grp, size FROM segments WHERE name IN ({0})'.format(marks),
+                                     list(names)).fetchall()
+                gone = set(name for (name, _, _) in rows)
+                for gid in set(grp for (_, grp, _) in rows):
+                    # Runs of segments left between the evicted ones
+                    runs = [[]]
+                    for (name, start, end) in index.execute('SELECT name, start_ns, end_ns FROM segments'
+                                                            ' WHERE grp = ? ORDER BY start_ns, end_ns, name', (gid,)):
+                        if name in gone:
+                            if runs[-1]:
+                                runs.append([])
+                        else:
+                            runs[-1].append((name, start, end))
+                    runs = [run for run in runs if run]
+                    if not runs:
+                        index.execute('DELETE FROM groups WHERE id = ?', (gid,))
+                    for k, run in enumerate(runs):
+                        bounds = (min(start for (_, start, _) in run), max(end for (_, _, end) in run))
+                        if k == 0:
+                            index.execute('UPDATE groups SET start_ns = ?, end_ns = ? WHERE id = ?', bounds + (gid,))
+                            continue
+                        new = index.execute('INSERT INTO groups (start_ns, end_ns) VALUES (?, ?)', bounds).lastrowid
+                        index.executemany('UPDATE segments SET grp = ? WHERE name = ?', [(new, name) for (name, _, _) in run])
+                index.executemany('DELETE FROM segments WHERE name = ?', [(name,) for name in gone])
+            # The files go once they're out of the index
+            for (name, _, size) in rows:
+                try:
+                    os.remove(os.path.join(self.cache_dir, name))
+                except FileNotFoundError:
+                    pass
+                freed += size
+        return freed
+
+    def read_segment(self, name):
+        """
+        Returns the samples in the cache file `name` as a `SampleBlock`. Binary
+        segments are memory mapped, or decoded if compressed. Old text segments
+        are parsed.
+        """
+        path = os.path.join(self.cache_dir, name)
+        with open(path, 'rb') as source:
+            magic = source.read(len(EXPORT_MAGIC))
+            if magic != EXPORT_MAGIC:
+                source.seek(0)
+                stamps = []
+                rows = []
+                for line in source:
+                    entry = line.split()
+                    if entry:
+                        stamps.append(entry[0].decode('ascii'))
+                        rows.append([float(x) for x in entry[1:]])
+                if not stamps:
+                    return SampleBlock.empty()
+                return SampleBlock(np.array(stamps, dtype='datetime64[ns]'), values_array(rows, np.float64))
+        return load_export(path)[1]
+
+    def _read_files(self, files, start, end):
+        files = [raw_entry for raw_entry in files if raw_entry.start <= end and raw_entry.end >= start]
+        self.touch([raw_entry.name for raw_entry in files])
+        return [self.read_segment(raw_entry.name).between(start, end) for raw_entry in files]
+
+    def read_index(self, index_entry, start=None, end=None):
+        """
+        Returns a list of `SampleBlock`s with the data for each of the files in
+        `index_entry`. If `start` or `end` are given, only the files with data
+        in between are read, and their blocks are cut to that range.
+        """
         if not isinstance(index_entry, IntervalIndexEntry):
             raise TypeError("Not an IntervalIndexEntry")
-        for raw_entry in index_entry.files:
-            with open(os.path.join(self.cache_dir, raw_entry.name)) as source:
-                for line in source:
-                    entry = line.strip().split()
-                    yield (np.datetime64(entry[0], 'ns'),) + tuple(float(x) for x in entry[1:])
+        start = index_entry.start if start is None else max(todatetime64(start), index_entry.start)
+        end = index_entry.end if end is None else min(todatetime64(end), index_entry.end)
+        with self.locked():
+            try:
+                return self._read_files(index_entry.files, start, end)
+            except FileNotFoundError:
+                # The group was compacted after looking it up. Read whatever
+                # covers the same range now
+                return list(chain.from_iterable(self._read_files(group.files, start, end)
+                                                for group in self.get_intersection(start, end, refresh=True)))
+
+    def iterate_index(self, index_entry):
+        return chain.from_iterable(self.read_index(index_entry))
+
+def cache_managers(root_dir):
+    "Yields a `RawCacheManager` for each channel (and kind of data) cached under `root_dir`"
+    for path, dirs, files in os.walk(root_dir):
+        if CACHE_INDEX_NAME in files or CACHE_LEGACY_INDEX_NAME in files:
+            parts = os.path.relpath(path, root_dir).split(os.sep)
+            if len(parts) == 4:
+                yield RawCacheManager(root_dir, *parts)
+
+CachePin = namedtuple('CachePin', 'label start end')
+
+def read_zones(path, tz=None, nights=False):
+    """
+    Reads a file with time ranges, in the format used for the zones of the
+    plotting tools (lines of `label, start, end[, color]`, with times like
+    `2018-05-07 09:42:39`), and returns them as a list of `CachePin`.
+
+    `tz` is the time zone of the times in the file (a `tzinfo`, or a name
+    like `'America/Santiago'`). They're taken as UTC if it's omitted. With
+    `nights=True`, each range is widened to the nights it touches, from
+    noon to noon, local time.
+    """
+    if isinstance(tz, str):
+        tz = ZoneInfo(tz)
+    def utc(local):
+        if tz is not None:
+            local = local.replace(tzinfo=tz).astimezone(timezone.utc).replace(tzinfo=None)
+        return np.datetime64(local, 'ns')
+    result = []
+    try:
+        with open(path) as source:
+            for row in csv.reader(source, skipinitialspace=True):
+                if len(row) < 3 or row[0].strip().startswith('#'):
+                    continue
+                start = datetime.strptime(row[1].strip(), '%Y-%m-%d %H:%M:%S')
+                end = datetime.strptime(row[2].strip(), '%Y-%m-%d %H:%M:%S')
+                if nights:
+                    start = start.replace(hour=12, minute=0, second=0) - timedelta(days=int(start.hour < 12))
+                    end = end.replace(hour=12, minute=0, second=0) + timedelta(days=int(end.hour >= 12))
+                result.append(CachePin(row[0].strip(), utc(start), utc(end)))
+    except FileNotFoundError:
+        pass
+    return result
+
+def load_pins(root_dir):
+    "Returns the ranges pinned in the cache at `root_dir` (see `pin_range`)"
+    return read_zones(os.path.join(root_dir, CACHE_PINS_NAME))
+
+def pin_range(root_dir, start, end, label='pinned'):
+    """
+    Protects the data between `start` and `end` (for all the channels) in
+    the cache at `root_dir` from eviction. The pins are kept in the same
+    format as the zones files, in UTC.
+    """
+    if not os.path.exists(root_dir):
+        os.makedirs(root_dir, exist_ok=True)
+    stamps = [todatetime(np.datetime64(todatetime64(x), 's')).strftime('%Y-%m-%d %H:%M:%S') for x in (start, end)]
+    with open(os.path.join(root_dir, CACHE_PINS_NAME), 'a') as dest:
+        dest.write('{0}, {1}, {2}\n'.format(label.replace(',', ' '), *stamps))
+
+def evict_cache(root_dir, max_bytes=None, budgets=None, pins=()):
+    """
+    Keeps the cache at `root_dir` within budget, removing the segments
+    that were read least recently first. `max_bytes` limits the size of the
+    whole cache, and `budgets` maps sites (eg. `'CP'`) and `(site, db)`
+    pairs (eg. `('CP', 'mcs')`) to their own limits, in bytes. Data within
+    the pinned ranges (the `pins` given, plus `load_pins(root_dir)`) is
+    never evicted. Returns the number of bytes freed.
+    """
+    budgets = dict(budgets or {})
+    if max_bytes is not None:
+        budgets[None] = max_bytes
+    pins = list(pins) + load_pins(root_dir)
+    pin_starts = np.array([tonanoseconds(pin.start) for pin in pins], dtype=np.int64)
+    pin_ends = np.array([tonanoseconds(pin.end) for pin in pins], dtype=np.int64)
+
+    totals = {}
+    candidates = []
+    managers = list(cache_managers(root_dir))
+    for rcm in managers:
+        keys = (None, rcm.site, (rcm.site, rcm.db))
+        for (name, start, end, size, atime) in rcm.segments():
+            for key in keys:
+                totals[key] = totals.get(key, 0) + size
+            if not np.any((pin_starts <= end) & (pin_ends >= start)):
+                candidates.append((atime, size, name, rcm))
+
+    victims = {}
+    for (atime, size, name, rcm) in sorted(candidates, key=lambda x: x[:3]):
+        keys = [key for key in (None, rcm.site, (rcm.site, rcm.db)) if key in budgets]
+        if any(totals[key] > budgets[key] for key in keys):
+            victims.setdefault(rcm, []).append(name)
+            for key in (None, rcm.site, (rcm.site, rcm.db)):
+                totals[key] -= size
 
-def map_pv_to_db(pvname):
+    freed = 0
+    for rcm in managers:
+        if rcm in victims:
+            freed += rcm.evict(victims[rcm])
+        rcm.close()
+    return freed
+
+def compact_cache(root_dir):
+    """
+    Compacts every cached channel under `root_dir` (see `RawCacheManager.compact`).
+    Returns the number of segments that were replaced.
+    """
+    replaced = 0
+    for rcm in cache_managers(root_dir):
+        replaced += rcm.compact()
+        rcm.close()
+    return replaced
+
+def map_pv_to_db(pvname, catalog=None):
+    """
+    Returns the name of the archive for `pvname`. If a `catalog` is given,
+    and it knows about the channel, the answer comes from it. Otherwise, the
+    archive is guessed from the prefix of the name, using `ARCHIVE_MAPPING`.
+    """
+    if catalog is not None:
+        archive = catalog.archive_for(pvname)
+        if archive is not None:
+            return archive
     key = (pvname.split(':') if ':' in pvname else pvname.split('.'))[0]
     return ARCHIVE_MAPPING[key]
 
@@ -424,11 +2999,24 @@ def sorted_zip(*args):
 
 
 class DataManager(object):
-    def __init__(self, exporter, root_dir=None):
+    """
+    Retrieves data using `exporter`, caching it under `root_dir`. If any of
+    `max_bytes` or `budgets` is given, the cache is kept within them after
+    downloading new data, as explained for `evict_cache`, which also
+    describes `pins`. New data is cached compressed with `codec`, if given
+    (see `RawCacheManager`).
+    """
+    def __init__(self, exporter, root_dir=None, max_bytes=None, budgets=None, pins=(), codec=None):
+        if codec is not None and codec not in EXPORT_CODECS:
+            raise ValueError("Unknown codec: {0}".format(codec))
         self.exp = exporter
         self.root = root_dir if root_dir is not None else os.getcwd()
+        self.codec = codec
+        self.max_bytes = max_bytes
+        self.budgets = budgets
+        self.pins = pins
 
-    def getData(self, pvname, start, end, db=None, cache_data=True, cache_query=False):
+    def getData(self, pvname, start, end, db=None, cache_data=True, cache_query=False, decimation=None):
         """
         `pvname`: The channel access descriptor to the desired Process Variable
         `start`:  `datetime` compatible object with the first timestamp for the query
@@ -445,37 +3033,75 @@ class DataManager(object):
                   is created for this specific query. Beware, unlike the data downloaded,
                   affected by `cache_data`, overlapping queries are stored separately,
                   in full. By default, this argument is `False`.
+        `decimation`:
+                  A `Decimation` instance, to get the data binned by the archiver
+                  instead of the raw samples. Useful for long period overviews.
+                  Decimated data is cached apart from the raw one, for each mode
+                  and bin width.
+        """
+        yield from iter_samples(self.getBlocks(pvname, start, end, db=db, cache_data=cache_data,
+                                               cache_query=cache_query, decimation=decimation))
+
+    def getBlocks(self, pvname, start, end, db=None, cache_data=True, cache_query=False, decimation=None):
+        """
+        Like `getData`, but yields the samples in `SampleBlock`s, as they're read
+        from the cache or retrieved from the archiver.
         """
         if db is None:
-            db = map_pv_to_db(pvname)
+            db = self.exp.find_archive(pvname)
 
         start = todatetime64(start)
         end = todatetime64(end)
 
-        rcm = RawCacheManager(self.root, self.exp.site, db, pvname)
-        # Gather missing intervals
-        overlap = rcm.get_intersection(start, end)
-        difference = rcm.get_difference(start, end)
+        kind = 'raw' if decimation is None else decimation.cache_name
+        rcm = RawCacheManager(self.root, self.exp.site, db, pvname, kind=kind, codec=self.codec)
+        # Gather missing intervals. Both lookups must see the same index
+        with rcm.locked():
+            overlap = rcm.get_intersection(start, end)
+            difference = rcm.get_difference(start, end)
+        latest = None
+
+        def fresh(block):
+            # The samples at the edges of a gap (and, for decimated data, the
+            # bins, which are aligned to their width) may come both from the
+            # cache and from the archiver
+            nonlocal latest
+            block = block.after(latest)
+            if len(block) > 0:
+                latest = block.stamps[-1]
+            return block
+
         for interval in sorted_zip(overlap, difference):
             if isinstance(interval, IntervalIndexEntry):
-                for entry in rcm.iterate_index(interval):
-                    if start <= entry[0] <= end:
-                        yield entry
+                for block in rcm.read_index(interval, start, end):
+                    block = fresh(block)
+                    if len(block) > 0:
+                        yield block
             else:
                 istart, iend = interval
                 with rcm.new_file() as dest:
-                    for entry in self.exp.retrieve(db, pvname, istart, iend):
-                        dest.write(entry[0], entry[1:])
-                        yield entry
+                    for block in self.exp.retrieve_blocks(db, pvname, istart, iend, decimation=decimation):
+                        dest.write_block(block.stamps, block.values)
+                        block = fresh(block)
+                        if len(block) > 0:
+                            yield block
+                    # Nothing is missing in between the neighbouring groups
+                    dest.cover(istart, iend)
+        if difference and (self.max_bytes is not None or self.budgets):
+            evict_cache(self.root, max_bytes=self.max_bytes, budgets=self.budgets, pins=self.pins)
 
-def get_exporter(source):
+def get_exporter(source, workers=1, prefetch=False):
     """
     If `source` is one of `'MK'` or `'CP'`, an instance of `ArchiveXmlRpcExporter` will
     be returned. Otherwise, an instance of `ArchiveFileExporter` initialized with `source`
     as the database name.
+
+    `workers` is the number of concurrent connections that the XML-RPC exporter will
+    use to retrieve each query, and `prefetch` enables fetching the next page of
+    samples in the background (for serial retrieval).
     """
     if source in ARCHIVE_SITE_URL:
-        return ArchiveXmlRpcExporter(source)
+        return ArchiveXmlRpcExporter(source, workers=workers, prefetch=prefetch)
     else:
         return ArchiveFileExporter(source)
 
@@ -0,0 +1,299 @@
+# vim: ai:sw=4:sts=4:expandtab
+
+###########################################################
+#
+#  Stand-in for the GEA ArchiveDataServer. It speaks the same
+#  XML-RPC protocol (archiver.archives, archiver.names and
+#  archiver.values), serving synthetic, deterministic channels,
+#  so that the exporters and the cache can be exercised and
+#  benchmarked without access to the summit archivers.
+#
+#  It can also play the part of the ArchiveExport tool, for
+#  ArchiveFileExporter:
+#
+#    ArchiveFileExporter('sim', bin_exec=[sys.executable, '-m',
+#                        'swglib.fakearchive', '--export'])
+#
+###########################################################
+
+import argparse
+import math
+import re
+import sys
+import threading
+import time
+from datetime import datetime
+from socketserver import ThreadingMixIn
+from xmlrpc.server import SimpleXMLRPCServer, SimpleXMLRPCRequestHandler
+
+HOW_RAW = 0
+HOW_SPREADSHEET = 1
+HOW_AVERAGE = 2
+HOW_PLOTBIN = 3
+HOW_LINEAR = 4
+
+# Defaults for the synthetic data span: 2018-01-01 - 2019-01-01 (UTC)
+DEFAULT_FIRST = 1514764800
+DEFAULT_LAST = 1546300800
+
+class SyntheticChannel(object):
+    """
+    A channel producing `rate` samples per second, each of them with `width`
+    elements, between `first` and `last` (seconds since the epoch). Sample `k`
+    is stamped at `first + k / rate` and its values are a pure function of `k`,
+    so every query against the same channel yields the same data.
+    """
+    def __init__(self, name, rate, width=1, first=DEFAULT_FIRST, last=DEFAULT_LAST):
+        self.name = name
+        self.rate = rate
+        self.width = width
+        self.first = first
+        self.last = last
+        self.period_ns = int(round(1000000000 / rate))
+        self.total = int((last - first) * 1000000000 // self.period_ns) + 1
+
+    def stamp(self, k):
+        "Returns the timestamp for sample `k`, in nanoseconds"
+        return self.first * 1000000000 + k * self.period_ns
+
+    def value(self, k):
+        t = k / self.rate
+        return [math.sin(t / 60. + i) * 100. + i for i in range(self.width)]
+
+    def index_at_or_before(self, ns):
+        k = (ns - self.first * 1000000000) // self.period_ns
+        return min(k, self.total - 1)
+
+    def sample(self, k, value=None):
+        secs, nano = divmod(self.stamp(k), 1000000000)
+        return {'stat': 0, 'sevr': 0,
+                'secs': secs, 'nano': nano,
+                'value': self.value(k) if value is None else value}
+
+    def raw(self, start, end, count):
+        # As the real server does, start with the sample valid at `start`
+        k = max(self.index_at_or_before(start), 0)
+        kend = self.index_at_or_before(end)
+        return [self.sample(i) for i in range(k, min(kend + 1, k + count))]
+
+    def binned(self, start, end, count, how):
+        delta = max((end - start) // max(count, 1), 1)
+        result = []
+        for b in range(count):
+            bstart = start + b * delta
+            bend = bstart + delta - 1
+            k1 = max(self.index_at_or_before(bstart - 1) + 1, 0)
+            k2 = self.index_at_or_before(bend)
+            if k2 < k1:
+                continue
+            if how == HOW_AVERAGE:
+                values = [self.value(k) for k in range(k1, k2 + 1)]
+                avg = [sum(col) / len(col) for col in zip(*values)]
+                result.append(self.sample((k1 + k2) // 2, avg))
+            else:
+                values = [(self.value(k)[0], k) for k in range(k1, k2 + 1)]
+                picks = sorted(set([k1, min(values)[1], max(values)[1], k2]))
+                result.extend(self.sample(k) for k in picks)
+        return result
+
+class IntermittentChannel(SyntheticChannel):
+    """
+    A `SyntheticChannel` that only has data during the first `on` seconds of
+    every `every` seconds, like the channels of a system that is turned on
+    and off. Sample `k` is the `k`-th one that actually exists.
+    """
+    def __init__(self, name, rate, on, every, width=1, first=DEFAULT_FIRST, last=DEFAULT_LAST):
+        self.per_cycle = int(on * rate)
+        self.every_ns = int(every * 1000000000)
+        super().__init__(name, rate, width=width, first=first, last=last)
+        self.total = self.index_at_or_before(last * 1000000000) + 1
+
+    def stamp(self, k):
+        cycle, n = divmod(k, self.per_cycle)
+        return self.first * 1000000000 + cycle * self.every_ns + n * self.period_ns
+
+    def index_at_or_before(self, ns):
+        cycle, offset = divmod(ns - self.first * 1000000000, self.every_ns)
+        k = cycle * self.per_cycle + min(offset // self.period_ns, self.per_cycle - 1)
+        return min(k, self.total - 1)
+
+DEFAULT_CHANNELS = {
+    'sim': [
+        SyntheticChannel('sim:scalar10', rate=10),
+        SyntheticChannel('sim:scalar20', rate=20),
+        SyntheticChannel('sim:array10', rate=10, width=16),
+        SyntheticChannel('sim:array20', rate=20, width=16),
+        SyntheticChannel('sim:slow', rate=1/60.),
+        # Half an hour of data a day, starting at midnight
+        IntermittentChannel('sim:intermittent', rate=10, on=1800, every=86400),
+        ],
+    }
+
+class ArchiveDataServerStandIn(object):
+    """
+    Implements the subset of the ArchiveDataServer API used by `swglib.export`.
+
+    `archives` maps archive names to lists of `SyntheticChannel`. `latency`
+    is the number of seconds to sleep before answering each request, to
+    emulate the long haul link to the summit. `max_count` caps the number of
+    samples returned per channel by `archiver.values`, as the real server does.
+    """
+    def __init__(self, archives=None, latency=0, max_count=10000):
+        archives = archives if archives is not None else DEFAULT_CHANNELS
+        self.archives = dict((name, dict((ch.name, ch) for ch in channels))
+                             for (name, channels) in archives.items())
+        self.keys = dict((name, n + 1) for (n, name) in enumerate(sorted(self.archives)))
+        self.latency = latency
+        self.max_count = max_count
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def _enter(self):
+        with self._lock:
+            self.requests += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _archive(self, key):
+        for name, k in self.keys.items():
+            if k == key:
+                return self.archives[name]
+        raise ValueError("Invalid key {0}".format(key))
+
+    def xr_archives(self):
+        self._enter()
+        return [{'key': k, 'name': name, 'path': '/fake/{0}/master_index'.format(name)}
+                for (name, k) in sorted(self.keys.items(), key=lambda x: x[1])]
+
+    def xr_names(self, key, pattern):
+        self._enter()
+        regex = re.compile(pattern)
+        return [{'name': ch.name,
+                 'start_sec': ch.first, 'start_nano': 0,
+                 'end_sec': divmod(ch.stamp(ch.total - 1), 1000000000)[0],
+                 'end_nano': divmod(ch.stamp(ch.total - 1), 1000000000)[1]}
+                for ch in sorted(self._archive(key).values(), key=lambda x: x.name)
+                if regex.search(ch.name)]
+
+    def xr_values(self, key, names, start_sec, start_nano, end_sec, end_nano, count, how):
+        self._enter()
+        archive = self._archive(key)
+        start = start_sec * 1000000000 + start_nano
+        end = end_sec * 1000000000 + end_nano
+        count = min(count, self.max_count)
+        result = []
+        for name in names:
+            ch = archive.get(name)
+            if ch is None:
+                values = []
+                width = 1
+            else:
+                width = ch.width
+                if how in (HOW_AVERAGE, HOW_PLOTBIN):
+                    values = ch.binned(start, end, count, how)
+                else:
+                    values = ch.raw(start, end, count)
+            result.append({'name': name,
+                           'meta': {'type': 1, 'disp_low': 0.0, 'disp_high': 0.0,
+                                    'alarm_low': 0.0, 'alarm_high': 0.0,
+                                    'warn_low': 0.0, 'warn_high': 0.0, 'prec': 9, 'units': ''},
+                           'type': 3,
+                           'count': width,
+                           'values': values})
+        return result
+
+class _QuietHandler(SimpleXMLRPCRequestHandler):
+    rpc_paths = ('/run/ArchiveDataServer.cgi', '/RPC2')
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+class _ThreadedServer(ThreadingMixIn, SimpleXMLRPCServer):
+    daemon_threads = True
+
+def make_server(host='127.0.0.1', port=0, **kw):
+    """
+    Builds (but does not start) an XML-RPC server on `host:port` answering to
+    the ArchiveDataServer methods. `port=0` picks a free port. Extra keyword
+    arguments are passed to `ArchiveDataServerStandIn`. The stand-in is
+    available as the `archive` attribute of the returned server, and its
+    URL as `url`.
+    """
+    server = _ThreadedServer((host, port), requestHandler=_QuietHandler,
+                             logRequests=False, allow_none=True)
+    archive = ArchiveDataServerStandIn(**kw)
+    server.register_function(archive.xr_archives, 'archiver.archives')
+    server.register_function(archive.xr_names, 'archiver.names')
+    server.register_function(archive.xr_values, 'archiver.values')
+    server.archive = archive
+    server.url = 'http://{0}:{1}/run/ArchiveDataServer.cgi'.format(*server.server_address)
+    return server
+
+def serve_in_background(**kw):
+    """
+    Starts a stand-in server on a daemon thread and returns it. Call
+    `shutdown()` on the returned object to stop it.
+    """
+    server = make_server(**kw)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+def _find_channel(name, archives=DEFAULT_CHANNELS):
+    for channels in archives.values():
+        for ch in channels:
+            if ch.name == name:
+                return ch
+
+def _export_ns(text):
+    dt = datetime.strptime(text, '%m/%d/%Y %H:%M:%S.%f')
+    return int((dt - datetime(1970, 1, 1)).total_seconds()) * 1000000000 + dt.microsecond * 1000
+
+def export_main(argv, out=sys.stdout):
+    """
+    Emulates `ArchiveExport <index> <channel> -start ... -end ... [-average|-plotbin
+    <seconds>] [-output <file>]`, writing the data for one of the synthetic
+    channels in its decimal text format.
+    """
+    channel = argv[1]
+    opts = dict(zip(argv[2::2], argv[3::2]))
+    ch = _find_channel(channel)
+    if ch is None:
+        print("Unknown channel '{0}'".format(channel), file=sys.stderr)
+        return 1
+    start = _export_ns(opts['-start'])
+    end = _export_ns(opts['-end'])
+    if '-average' in opts or '-plotbin' in opts:
+        how, width = (HOW_AVERAGE, opts['-average']) if '-average' in opts else (HOW_PLOTBIN, opts['-plotbin'])
+        count = max(int((end - start) // int(float(width) * 1000000000)), 1)
+        samples = ch.binned(start, end, count, how)
+        method = 'Average' if how == HOW_AVERAGE else 'Plot-Binning'
+    else:
+        samples = ch.raw(start, end, ch.total)
+        method = 'Raw Data'
+    dest = open(opts['-output'], 'w') if '-output' in opts else out
+    try:
+        dest.write('# Generated by ArchiveExport (stand-in)\n# Method: {0}\n\n# Time\t{1}\n'.format(method, channel))
+        for sample in samples:
+            stamp = datetime.utcfromtimestamp(sample['secs']).strftime('%m/%d/%Y %H:%M:%S')
+            dest.write('{0}.{1:09d}\t{2}\n'.format(stamp, sample['nano'],
+                                                   '\t'.join('{0:.9f}'.format(v) for v in sample['value'])))
+    finally:
+        if dest is not out:
+            dest.close()
+    return 0
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--export']:
+        sys.exit(export_main(sys.argv[2:]))
+
+    parser = argparse.ArgumentParser(description='Local ArchiveDataServer stand-in')
+    parser.add_argument('-p', '--port', dest='port', type=int, default=8080, help='Port to listen on')
+    parser.add_argument('-l', '--latency', dest='latency', type=float, default=0,
+                        help='Seconds to wait before answering each request')
+    args = parser.parse_args()
+
+    server = make_server(port=args.port, latency=args.latency)
+    print("Serving on", server.url)
+    server.serve_forever()
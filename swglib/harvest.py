@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+
+# vim: ai:sw=4:sts=4:expandtab
+
+###########################################################
+#
+#  Bulk export of archived channels. Splits the requested
+#  period in windows, exports each (channel, window) pair to
+#  its own file using a pool of processes, and keeps a
+#  manifest of the finished jobs, so that an interrupted
+#  harvest can be resumed by running the same command again.
+#
+###########################################################
+
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime, timedelta
+from time import monotonic
+import argparse
+import json
+import os
+import sys
+
+from swglib.export import archive_export, map_pv_to_db, ArchiveXmlRpcExporter, PRIORITY_BULK
+
+HarvestJob = namedtuple('HarvestJob', 'db channel start end output')
+
+DEFAULT_STEP = timedelta(hours=12)
+MANIFEST_NAME = 'manifest.jsonl'
+FORMAT_EXTENSION = {'text': 'txt', 'npy': 'npy'}
+
+def job_key(job):
+    return (job.channel, job.start.isoformat(), job.end.isoformat())
+
+def output_name(outdir, site, db, channel, start, output_format='text'):
+    """
+    Path for the file holding the data for `channel` starting at `start`,
+    following the layout used by the old harvest scripts:
+    `<outdir>/<db>/<channel>/<date>_<site>_<channel>_export.txt`
+    """
+    chname = channel.replace(':', '-')
+    fname = '{0}_{1}_{2}_export.{3}'.format(start.strftime('%Y-%m-%dT%H%M%S'), site or 'local', chname,
+                                            FORMAT_EXTENSION[output_format])
+    return os.path.join(outdir, db, chname, fname)
+
+def plan_jobs(channels, start, end, outdir, step=DEFAULT_STEP, site=None, db=None, output_format='text'):
+    """
+    Splits `[start, end)` in windows of `step` and returns a `HarvestJob` for
+    each channel and window. The jobs are sorted by window, so that all the
+    channels progress at the same pace.
+    """
+    jobs = []
+    if db is not None:
+        archives = dict((channel, db) for channel in channels)
+    elif site is not None:
+        # Ask the site's catalog (and, for the channels it doesn't know yet,
+        # the server) once per channel
+        exporter = ArchiveXmlRpcExporter(site)
+        archives = dict((channel, exporter.find_archive(channel)) for channel in channels)
+    else:
+        archives = dict((channel, map_pv_to_db(channel)) for channel in channels)
+    wstart = start
+    while wstart < end:
+        wend = min(wstart + step, end)
+        for channel in channels:
+            chdb = archives[channel]
+            jobs.append(HarvestJob(db=chdb, channel=channel, start=wstart, end=wend,
+                                   output=output_name(outdir, site, chdb, channel, wstart, output_format)))
+        wstart = wend
+    return jobs
+
+def load_manifest(path):
+    "Returns the set of keys for the jobs recorded as finished in the manifest at `path`"
+    done = set()
+    try:
+        with open(path) as source:
+            for line in source:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # A line truncated by an interrupted write
+                    continue
+                done.add((entry['channel'], entry['start'], entry['end']))
+    except (IOError, OSError):
+        pass
+    return done
+
+def run_job(job, site, output_format='text'):
+    """
+    Exports the data for `job`. The output is written to a temporary name and
+    renamed when complete, so that an interrupted job never leaves a partial
+    file that looks finished.
+    """
+    t0 = monotonic()
+    outdir = os.path.dirname(job.output)
+    if not os.path.exists(outdir):
+        os.makedirs(outdir, exist_ok=True)
+    partial = job.output + '.part'
+    if not archive_export(job.db, job.channel, partial, start=job.start, end=job.end,
+                          site=site, overwrite=True, output_format=output_format,
+                          priority=PRIORITY_BULK):
+        raise RuntimeError("Export failed for {0} ({1} - {2})".format(job.channel, job.start, job.end))
+    os.rename(partial, job.output)
+    return os.path.getsize(job.output), monotonic() - t0
+
+def harvest(jobs, manifest, site=None, workers=None, report=None, output_format='text'):
+    """
+    Runs the `jobs` that are not yet recorded in the `manifest` (a JSON lines
+    file) using a pool of up to `workers` processes (by default, one per CPU).
+    Each job is appended to the manifest as soon as it finishes.
+
+    `report`, if given, is called as `report(job, result)` after each job,
+    where `result` is the size of the output file, or the exception raised
+    by the job. Returns the list of jobs that failed.
+    """
+    done = load_manifest(manifest)
+    pending = iter([job for job in jobs if job_key(job) not in done or not os.path.exists(job.output)])
+    workers = workers or os.cpu_count() or 1
+    failed = []
+
+    with open(manifest, 'a') as record, ProcessPoolExecutor(max_workers=workers) as pool:
+        def submit():
+            job = next(pending, None)
+            if job is not None:
+                running[pool.submit(run_job, job, site, output_format)] = job
+
+        # Keep a bounded number of jobs queued, instead of the whole plan
+        running = {}
+        for k in range(workers * 2):
+            submit()
+        while running:
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                job = running.pop(future)
+                try:
+                    size, elapsed = future.result()
+                except Exception as e:
+                    failed.append(job)
+                    result = e
+                else:
+                    channel, start, end = job_key(job)
+                    record.write(json.dumps({'channel': channel, 'start': start, 'end': end,
+                                             'output': job.output, 'size': size,
+                                             'elapsed': round(elapsed, 3)}) + '\n')
+                    record.flush()
+                    os.fsync(record.fileno())
+                    result = size
+                if report is not None:
+                    report(job, result)
+                submit()
+    return failed
+
+def parse_time(text):
+    return datetime.fromisoformat(text)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Bulk export of archived channels')
+    parser.add_argument('-s', '--site', dest='site', default=None,
+                        help='Archive site (MK or CP). If omitted, use ArchiveExport locally')
+    parser.add_argument('-d', '--db', dest='db', default=None,
+                        help='Archive (eg. mcs). By default, derived from each channel name')
+    parser.add_argument('-o', '--output', dest='outdir', default='.',
+                        help='Root directory for the exported files')
+    parser.add_argument('-m', '--manifest', dest='manifest', default=None,
+                        help='Manifest of finished jobs (default: <output>/{0})'.format(MANIFEST_NAME))
+    parser.add_argument('-j', '--jobs', dest='jobs', type=int, default=None,
+                        help='Number of concurrent exports (default: number of CPUs)')
+    parser.add_argument('-f', '--format', dest='format', choices=sorted(FORMAT_EXTENSION), default='text',
+                        help='Output format (npy files can be read using swglib.export.load_export)')
+    parser.add_argument('--step', dest='step', type=float, default=12,
+                        help='Hours of data per exported file')
+    parser.add_argument('start', type=parse_time, help='Start of the period (ISO 8601, eg. 2018-01-01T18:00)')
+    parser.add_argument('end', type=parse_time, help='End of the period')
+    parser.add_argument('channels', nargs='+', help='Channels to export')
+
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    manifest = args.manifest or os.path.join(args.outdir, MANIFEST_NAME)
+    if not os.path.exists(args.outdir):
+        os.makedirs(args.outdir)
+    jobs = plan_jobs(args.channels, args.start, args.end, args.outdir,
+                     step=timedelta(hours=args.step), site=args.site, db=args.db,
+                     output_format=args.format)
+
+    def report(job, result):
+        if isinstance(result, Exception):
+            print("FAILED {0} {1} - {2}: {3}".format(job.channel, job.start, job.end, result), file=sys.stderr)
+        else:
+            print("{0} {1} - {2}: {3} bytes".format(job.channel, job.start, job.end, result))
+
+    failed = harvest(jobs, manifest, site=args.site, workers=args.jobs, report=report,
+                     output_format=args.format)
+    if failed:
+        print("{0} jobs failed. Run the same command again to retry them".format(len(failed)), file=sys.stderr)
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
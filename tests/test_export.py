@@ -0,0 +1,201 @@
+import io
+import os
+import xmlrpc.client as xc
+from datetime import datetime, timedelta
+from urllib.request import Request, urlopen
+
+import numpy as np
+import pytest
+
+from swglib import export, harvest
+from swglib.export import ArchiveXmlRpcExporter, DataManager, PooledTransport, RawCacheManager, SampleBlock
+from swglib.fakearchive import serve_in_background
+
+START = datetime(2018, 5, 4)
+END = datetime(2018, 5, 4, 0, 30)
+CHANNELS = ('sim:scalar20', 'sim:array10')
+
+@pytest.fixture(scope='module')
+def server():
+    srv = serve_in_background()
+    yield srv
+    srv.shutdown()
+
+@pytest.fixture(autouse=True)
+def catalog_dir(tmp_path, monkeypatch):
+    # Keep the archive catalogs away from ~/.cache
+    monkeypatch.setattr(export, 'ARCHIVE_CATALOG_DIR', str(tmp_path / 'catalogs'))
+
+def fetch(exporter, channel):
+    return SampleBlock.concatenate(list(exporter.retrieve_blocks('sim', channel, START, END)))
+
+def assert_same(a, b):
+    assert np.array_equal(a.stamps, b.stamps)
+    assert np.array_equal(a.values, b.values)
+
+@pytest.mark.parametrize('channel', CHANNELS)
+def test_retrieval_modes_agree(server, channel):
+    serial = fetch(ArchiveXmlRpcExporter('SIM', url=server.url), channel)
+    # Long enough to need several pages
+    assert len(serial) > export.ARCHIVE_MAX_XMLRPC_SAMPLES
+    assert_same(serial, fetch(ArchiveXmlRpcExporter('SIM', url=server.url, workers=4), channel))
+    assert_same(serial, fetch(ArchiveXmlRpcExporter('SIM', url=server.url, prefetch=True), channel))
+    rows = list(ArchiveXmlRpcExporter('SIM', url=server.url).retrieve('sim', channel, START, END))
+    assert [row[0] for row in rows] == list(serial.stamps)
+
+@pytest.mark.parametrize('how', [0, 3])
+def test_values_parser_matches_stock_decoding(server, how):
+    key = [arch['key'] for arch in xc.ServerProxy(server.url).archiver.archives() if arch['name'] == 'sim'][0]
+    body = xc.dumps((key, list(CHANNELS) + ['sim:missing'], 1525392000, 0, 1525392300, 0, 1000, how),
+                    'archiver.values').encode()
+    response = urlopen(Request(server.url, body, {'Content-Type': 'text/xml'})).read()
+    stock = xc.loads(response)[0][0]
+    parsed = export.loads_values(response, 1000)[0]
+    assert len(parsed) == len(stock)
+    for (mine, theirs) in zip(parsed, stock):
+        assert isinstance(mine['values'], SampleBlock)
+        assert dict(mine, values=None) == dict(theirs, values=None)
+        assert_same(mine['values'], export.decode_block(theirs))
+
+@pytest.mark.parametrize('codec', [None, 'zlib'])
+def test_cache_round_trip(server, tmp_path, codec):
+    exporter = ArchiveXmlRpcExporter('SIM', url=server.url)
+    dm = DataManager(exporter, root_dir=str(tmp_path), codec=codec)
+    reference = fetch(exporter, 'sim:array10')
+    first = SampleBlock.concatenate(list(dm.getBlocks('sim:array10', START, END, db='sim')))
+    assert_same(first, reference)
+    requests = server.archive.requests
+    second = SampleBlock.concatenate(list(dm.getBlocks('sim:array10', START, END, db='sim')))
+    assert server.archive.requests == requests
+    assert_same(second, reference)
+    rcm = RawCacheManager(str(tmp_path), 'SIM', 'sim', 'sim:array10')
+    for (name, _, _, _, _) in rcm.segments():
+        header, block = export.load_export(os.path.join(rcm.cache_dir, name))
+        assert header.get('codec') == codec and block.width == 16
+    rcm.close()
+
+@pytest.mark.parametrize('count', [1, 2])
+def test_compressed_chunk_round_trip(count):
+    stamps = np.datetime64(START, 'ns') + np.arange(count) * np.timedelta64(100, 'ms')
+    block = SampleBlock(stamps, np.arange(count * 3, dtype=np.float64).reshape(count, 3))
+    dest = io.BytesIO()
+    export.write_compressed_records(dest, export.export_records(block, 3), 'zlib')
+    dest.seek(0)
+    assert_same(SampleBlock.concatenate(list(export.iter_compressed_records(dest, 3, 'zlib'))), block)
+
+def test_cache_single_sample_segments(server, tmp_path):
+    # sim:slow has a sample per minute, so each of these queries adds one
+    exporter = ArchiveXmlRpcExporter('SIM', url=server.url)
+    dm = DataManager(exporter, root_dir=str(tmp_path), codec='zlib')
+    start, end = datetime(2018, 5, 4, 0, 0, 30), datetime(2018, 5, 4, 0, 2, 10)
+    list(dm.getData('sim:slow', start, datetime(2018, 5, 4, 0, 1, 10), db='sim'))
+    list(dm.getData('sim:slow', start, end, db='sim'))
+    rcm = RawCacheManager(str(tmp_path), 'SIM', 'sim', 'sim:slow')
+    lengths = [len(export.load_export(os.path.join(rcm.cache_dir, name))[1])
+               for (name, _, _, _, _) in rcm.segments()]
+    rcm.close()
+    assert 1 in lengths
+    cached = SampleBlock.concatenate(list(dm.getBlocks('sim:slow', start, end, db='sim')))
+    reference = SampleBlock.concatenate(list(exporter.retrieve_blocks('sim', 'sim:slow', start, end)))
+    # The archiver also sends the sample in effect at `start`
+    assert_same(cached, reference.between(np.datetime64(start), np.datetime64(end)))
+
+def test_adaptive_sizer_skips_gaps(server):
+    # sim:intermittent only has data from 00:00 to 00:30 each day
+    start, end = datetime(2018, 5, 4), datetime(2018, 5, 6)
+    requests, blocks = [], []
+    for sizer in (export.PageSizer(), export.AdaptivePageSizer()):
+        exporter = ArchiveXmlRpcExporter('SIM', url=server.url, sizer=sizer)
+        exporter.find_archive('sim:intermittent')
+        before = server.archive.requests
+        blocks.append(SampleBlock.concatenate(list(exporter.retrieve_blocks('sim', 'sim:intermittent', start, end))))
+        requests.append(server.archive.requests - before)
+    assert_same(blocks[0], blocks[1])
+    # Bounded windows cost one short page each time the data stops (twice
+    # here), instead of one request per window all along the gaps
+    assert requests[1] <= requests[0] + 2
+
+def test_partial_commit(server, tmp_path, monkeypatch):
+    exporter = ArchiveXmlRpcExporter('SIM', url=server.url, retries=0)
+    reference = fetch(exporter, 'sim:scalar20')
+    calls = []
+    single_request = PooledTransport.single_request
+    def flaky(self, host, handler, body, verbose=False):
+        if b'archiver.values' in body:
+            calls.append(body)
+            if len(calls) == 3:
+                self.close()
+                raise ConnectionResetError('dropped')
+        return single_request(self, host, handler, body, verbose)
+    monkeypatch.setattr(PooledTransport, 'single_request', flaky)
+
+    dm = DataManager(exporter, root_dir=str(tmp_path))
+    delivered = []
+    with pytest.raises(ConnectionResetError):
+        for block in dm.getBlocks('sim:scalar20', START, END, db='sim'):
+            delivered.append(block)
+    delivered = SampleBlock.concatenate(delivered)
+    # What was delivered before the failure stays in the cache
+    rcm = RawCacheManager(str(tmp_path), 'SIM', 'sim', 'sim:scalar20')
+    intervals = rcm.get_intervals(True)
+    rcm.close()
+    assert len(intervals) == 1
+    assert intervals[0].start == delivered.stamps[0] and intervals[0].end == delivered.stamps[-1]
+    assert 0 < len(delivered) < len(reference)
+
+    del calls[:]
+    full = SampleBlock.concatenate(list(dm.getBlocks('sim:scalar20', START, END, db='sim')))
+    assert_same(full, reference)
+    # Only the missing part was asked for
+    assert len(calls) < 4
+
+def test_closing_stops_retrieval(server, tmp_path):
+    exporter = ArchiveXmlRpcExporter('SIM', url=server.url)
+    samples = exporter.retrieve('sim', 'sim:scalar20', START, END)
+    next(samples)
+    samples.close()
+
+    dm = DataManager(exporter, root_dir=str(tmp_path))
+    samples = dm.getData('sim:scalar20', START, END, db='sim')
+    first = next(samples)
+    requests = server.archive.requests
+    samples.close()
+    assert server.archive.requests == requests
+    # The page that was read is kept
+    rcm = RawCacheManager(str(tmp_path), 'SIM', 'sim', 'sim:scalar20')
+    intervals = rcm.get_intervals(True)
+    rcm.close()
+    assert len(intervals) == 1 and intervals[0].start == first[0] and intervals[0].end < np.datetime64(END)
+
+def test_harvest(server, tmp_path, monkeypatch):
+    monkeypatch.setitem(export.ARCHIVE_SITE_URL, 'SIM', server.url)
+    # Start with a cold catalog, so that planning has to ask the server
+    monkeypatch.setattr(export, '_site_catalogs', {})
+    outdir = str(tmp_path / 'out')
+    os.makedirs(outdir)
+    jobs = harvest.plan_jobs(list(CHANNELS), START, END, outdir, step=timedelta(minutes=10), site='SIM',
+                             output_format='npy')
+    assert len(jobs) == 6 and all(job.db == 'sim' for job in jobs)
+    manifest = os.path.join(outdir, harvest.MANIFEST_NAME)
+    results = []
+    failed = harvest.harvest(jobs, manifest, site='SIM', workers=3, output_format='npy',
+                             report=lambda job, result: results.append(result))
+    assert failed == [] and len(results) == 6
+    assert harvest.load_manifest(manifest) == set(harvest.job_key(job) for job in jobs)
+    exporter = ArchiveXmlRpcExporter('SIM', url=server.url)
+    for job in jobs:
+        header, block = export.load_export(job.output)
+        assert header['channel'] == job.channel
+        reference = SampleBlock.concatenate(list(exporter.retrieve_blocks('sim', job.channel, job.start, job.end)))
+        assert_same(block, reference)
+
+    # Everything is done: running it again does nothing
+    with open(manifest) as source:
+        recorded = source.read()
+    requests = server.archive.requests
+    results = []
+    failed = harvest.harvest(jobs, manifest, site='SIM', workers=3, output_format='npy',
+                             report=lambda job, result: results.append(result))
+    assert failed == [] and results == [] and server.archive.requests == requests
+    with open(manifest) as source:
+        assert source.read() == recorded